@@ -17,36 +17,33 @@ API server for led strip lights.
 This listens for API requests submitted over HTTP and interracts 
 with one or more LED devices using the led_strip module.
 """
-import sys
-
-import select
-import tty
-import termios
-import time
 import logging
-import math
-import pigpio
-import os
 import json
+import gzip
+import hashlib
+import threading
 
 from datetime import datetime
 
-from multiprocessing import Process
-
 from flask import Flask
 from flask import jsonify
 from flask import request
+from flask import Response
+from flask import abort
 
 from flask_swagger import swagger
 
 from flask_swagger_ui import get_swaggerui_blueprint
 
-from pytz import utc
 from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
-from apscheduler.executors.pool import ThreadPoolExecutor, ProcessPoolExecutor
+from apscheduler.events import EVENT_SCHEDULER_STARTED
+from apscheduler.executors.pool import ThreadPoolExecutor
 
-from led_strip import led_strip
+import led_daemon
+import light_jobs
+from job_scheduler import job_scheduler
+from jobstore import cached_jobstore
+from state_cache import state_stream
 
 # ============================================================
 # Logging
@@ -58,37 +55,30 @@ logging.basicConfig(level=logging.INFO,
 
 # ============================================================
 # LED Strip(s)
+#
+# With LED_DAEMON set to its socket, every worker sends its commands
+# to led_daemon, the one process that owns the strips. Otherwise this
+# process owns them, which is only right with a single worker.
 
-# Set pwm range from 0 to 255
-# Zero if full on 255 is full off
-# TODO: Load these from a config file
-pwm_range = 255
-
-# Define the LED devices
-leds = {}
-
-# TODO: Load these from a config file
-leds['tim'] = led_strip(2, 3, 4, pwm_range)
-leds['sharon'] = led_strip(17, 27, 22, pwm_range)
+hardware = led_daemon.connect()
 
-# Target time range to go from current levels to full on
-# when running the sunrise process.
-# TODO: Load these from a config file
-time_to_full = 600
+# Versioned snapshot of every strip's state, served by /state
+states = hardware.states
 
+# Longest a /state long-poll may wait, in seconds
+max_state_wait = 60
 
-# ============================================================
-# PiGpio : Connect to the pgpiod daemon. Currently on the same host
-# TODO: Allow multiple pigpio connections defined in a config file
-pi = pigpio.pi()
+# Live state for /events subscribers, at most 10 events a second
+stream = state_stream(states, fps=10)
 
 
 # ============================================================
 # Set up scheduler
-# Currently using SQLite on localhost.
+# Currently using SQLite on localhost, read once at start and then
+# kept in memory. Changes are written to it in the background.
 # Should I explore remote SQL servers? Overkill?
 jobstores = {
-    'default': SQLAlchemyJobStore(url='sqlite:///jobs.sqlite')
+    'default': cached_jobstore('jobs.sqlite')
 }
 executors = {
     'default': ThreadPoolExecutor(5)
@@ -98,6 +88,14 @@ job_defaults = {
     'max_instances': 3
 }
 
+# Where the lights are, for jobs relative to sunrise and sunset
+# TODO: Load these from a config file
+latitude = 34.05
+longitude = -118.24
+
+# Most fire times /schedule/<id>/timeline returns
+max_timeline = 366
+
 
 # ============================================================
 # Set up Flask and flask routing
@@ -105,7 +103,8 @@ job_defaults = {
 app = Flask(__name__)
 
 SWAGGER_URL = '/docs'
-API_URL = 'http://192.168.1.32:5000/spec'
+# Relative, so the docs load the spec from whatever host served them
+API_URL = '/spec'
 
 swaggerui_blueprint = get_swaggerui_blueprint(
     SWAGGER_URL,
@@ -117,6 +116,18 @@ swaggerui_blueprint = get_swaggerui_blueprint(
 
 app.register_blueprint(swaggerui_blueprint, url_prefix=SWAGGER_URL)
 
+@app.before_request
+def setup_leds():
+    """
+    Set up all the LED strips in one batch before the first request.
+
+    The strips do not talk to pigpio when they are created, so
+    importing this module (and uWSGI respawns) never wait on it.
+    """
+
+    hardware.setup()
+
+
 @app.route("/")
 def root():
     """
@@ -136,8 +147,73 @@ def spec():
     responses:
       200:
         description: Spec returned
+      304:
+        description: The spec has not changed since the ETag given in If-None-Match.
+    """
+
+    (body, zipped, etag) = built_spec()
+    # Each content coding is a different body, so gets its own ETag
+    use_gzip = 'gzip' in request.accept_encodings
+    if use_gzip:
+        etag += '-gz'
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif use_gzip:
+        response = Response(zipped, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    # On the 304 too, so caches keep the codings apart
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+# The swagger spec as (JSON, gzipped JSON, ETag), built on first use.
+# Building it parses every route's docstring.
+spec_cache = None
+spec_lock = threading.Lock()
+
+
+def built_spec():
+    """
+    Return the cached swagger spec, building it if needed.
     """
-    return jsonify(swagger(app))
+
+    global spec_cache
+    with spec_lock:
+        if spec_cache is None:
+            spec = swagger(app)
+            spec['parameters'] = {
+                'led': {
+                    'in': 'query',
+                    'name': 'led',
+                    'description': 'Device or group name, or a comma separated list of them. All devices if not given.',
+                    'required': False,
+                    'type': 'string',
+                },
+            }
+            body = json.dumps(spec, sort_keys=True).encode()
+            spec_cache = (body, gzip.compress(body, mtime=0), hashlib.sha1(body).hexdigest())
+        return spec_cache
+
+
+@app.route("/leds")
+def list_leds():
+    """
+    List the LED devices and groups
+    ---
+    tags:
+      - controls
+    summary: Return the devices and groups the led parameter takes
+    responses:
+      200:
+        description: A JSON object of devices, with their pins and PWM range, and groups with their devices.
+    """
+
+    return jsonify(hardware.describe())
 
 
 @app.route("/on")
@@ -147,17 +223,17 @@ def on():
     ---
     tags:
       - controls
-    summary: Turn on all the LED devices
+    summary: Turn on the LED devices
+    parameters:
+      - $ref: '#/parameters/led'
     responses:
       200:
-        description: All lights turned on
+        description: Lights turned on
+      404:
+        description: Unknown device or group
     """
 
-    ret = {}
-    for led in leds:
-        leds[led].on()
-        ret[led] = leds[led].get()
-    return jsonify(ret)
+    return jsonify(hardware.execute([{'led': request_targets(), 'action': 'on'}]))
 
 
 @app.route("/off")
@@ -167,17 +243,17 @@ def off():
     ---
     tags:
       - controls
-    summary: Turn off all the LED devices
+    summary: Turn off the LED devices
+    parameters:
+      - $ref: '#/parameters/led'
     responses:
       200:
-        description: All lights turned off
+        description: Lights turned off
+      404:
+        description: Unknown device or group
     """
 
-    ret = {}
-    for led in leds:
-        leds[led].off()
-        ret[led] = leds[led].get()
-    return jsonify(ret)
+    return jsonify(hardware.execute([{'led': request_targets(), 'action': 'off'}]))
 
 
 @app.route("/state")
@@ -188,15 +264,72 @@ def state():
     tags:
       - controls
     summary: Return the state of all devices
+    parameters:
+      - $ref: '#/parameters/led'
+      - in : query
+        name: wait
+        description: Long-poll. If the If-None-Match ETag is still current, wait up to this many seconds (max 60) for the state to change before answering. The wait holds a server thread.
+        required: false
+        type: number
     responses:
       200:
         description: Return a JSON structure showing the current state of all the lights.
+      304:
+        description: The state has not changed since the ETag given in If-None-Match.
+    """
+
+    (version, snapshot, body) = states.get()
+    etag = states.etag(version)
+
+    wait = request_value('wait', float)
+    if wait and request.if_none_match.contains(etag):
+        states.wait(version, min(wait, max_state_wait))
+        (version, snapshot, body) = states.get()
+        etag = states.etag(version)
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif request.args.get('led'):
+        body = json.dumps({led: snapshot[led] for led in device_names(request_targets())})
+        response = Response(body, mimetype='application/json')
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+@app.route("/events")
+def events():
     """
+    Stream light state changes
+    ---
+    tags:
+      - controls
+    summary: Server-Sent Events stream of the state of all devices
+    description: Sends the current state, then every change including fade and sunrise frames, at most 10 events a second. Slow clients skip intermediate frames. Each open stream holds a server thread, so the server must run with threads (see api_server.service).
+    parameters:
+      - in : query
+        name: fps
+        description: Most events a second to send to this client (up to 10)
+        required: false
+        type: number
+    produces:
+      - text/event-stream
+    responses:
+      200:
+        description: Event stream of state events with the same JSON as /state
+    """
+
+    fps = request_value('fps', float)
+    if fps is not None and fps <= 0:
+        fps = None
 
-    ret = {}
-    for led in leds:
-        ret[led] = leds[led].get()
-    return jsonify(ret)
+    response = Response(stream.subscribe(fps), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop nginx buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @app.route("/toggle")
@@ -206,30 +339,18 @@ def toggle():
     ---
     tags:
       - controls
-    summary: Toggle all the lights
+    summary: Toggle the lights
+    description: If every device given is in the same state they are toggled between that state and off, otherwise they are all turned off.
+    parameters:
+      - $ref: '#/parameters/led'
     responses:
       200:
         description: Toggle named/all LED devices between the current state and off
+      404:
+        description: Unknown device or group
     """
 
-    ret = {}
-    if request.args.get('led'):
-        led_in = request.args.get('led')
-        if leds[led_in]:
-            leds[led_in].toggle()
-    else:
-        led_sum = []
-        for led in leds:
-            led_sum.append(sum(leds[led].get()))
-       
-        for led in leds:
-            if min(led_sum) == max(led_sum) :
-                leds[led].toggle()
-            else:
-                leds[led].off()
-
-        ret[led] = leds[led].get()
-    return jsonify(ret)
+    return jsonify(hardware.execute([{'led': request_targets(), 'action': 'toggle'}]))
 
 
 @app.route("/rgb")
@@ -240,6 +361,7 @@ def rgb():
     tags:
       - controls
     parameters:
+      - $ref: '#/parameters/led'
       - in : query
         name: red
         description: red value from 0 to 255
@@ -268,45 +390,20 @@ def rgb():
     responses:
       200:
         description: Light color set
+      400:
+        description: A color is not an integer from 0 to 255
+      404:
+        description: Unknown device or group
     """
 
-    ret = {}
-    if request.args.get('red'):
-        red_in = request.args.get('red')
-    else:
-        red_in = None
-
-    if request.args.get('blue'):
-        blue_in = request.args.get('blue')
-    else:
-        blue_in = None
-
-    if request.args.get('green'):
-        green_in = request.args.get('green')
-    else:
-        green_in = None
-
-    for led in leds:
-        if red_in is None:
-            red = leds[led].get_red()
-        else: 
-            red = red_in
+    op = {'led': request_targets(), 'action': 'rgb'}
+    for color in ('red', 'green', 'blue'):
+        op[color] = request_value(color, int)
 
-        if blue_in is None:
-            blue = leds[led].get_blue()
-        else: 
-            blue = blue_in
-
-        if green_in is None:
-            green = leds[led].get_green()
-        else: 
-            green = green_in
-
-        print("red: {}  green: {}  blue: {}".format(red, green, blue))
-
-        leds[led].set(red, blue, green)
-        ret[led] = leds[led].get()
-    return jsonify(ret)
+    try:
+        return jsonify(hardware.execute([op]))
+    except ValueError as e:
+        return jsonify({'errors': e.args[0]}), 400
 
 
 @app.route("/sunrise")
@@ -317,17 +414,79 @@ def sunrise():
     tags:
       - controls
     summary: 
+    parameters:
+      - $ref: '#/parameters/led'
     responses:
       200:
         description: Sunrise started
+      404:
+        description: Unknown device or group
+    """
+
+    leds = request_targets()
+    logging.info(f'Starting sunrise on {leds}')
+    return jsonify(hardware.execute([{'led': leds, 'action': 'scene', 'scene': 'sunrise'}]))
+
+
+@app.route("/batch", methods=['POST'])
+def batch():
+    """
+    Apply many changes to the LED devices at once.
+    ---
+    tags:
+      - controls
+    summary: Apply a list of per device operations together
+    description: The body is a JSON list of operations, each naming a device (led) and an action. The whole list is checked first; if any operation is invalid nothing is changed. Valid lists are applied in order and every fade and scene they start begins on the same frame.
+    consumes:
+      - application/json
+    parameters:
+      - in: body
+        name: operations
+        required: true
+        schema:
+          type: array
+          items:
+            type: object
+            required:
+              - led
+              - action
+            properties:
+              led:
+                type: string
+                description: device or group name, or a list of them
+              action:
+                type: string
+                enum: [rgb, on, off, toggle, scene, disarm, fade_duration]
+              red:
+                type: integer
+                description: rgb only, current value if not given
+              green:
+                type: integer
+                description: rgb only, current value if not given
+              blue:
+                type: integer
+                description: rgb only, current value if not given
+              scene:
+                type: string
+                description: scene, the scene to run, or disarm, the scene to cancel
+              at:
+                type: number
+                description: scene only, Unix time to start it at instead of now
+              duration:
+                type: number
+                description: scene run time, or the new fade duration, in seconds
+    responses:
+      200:
+        description: Operations applied. Returns the state of the devices changed.
+      400:
+        description: Invalid operations. Returns a list of errors, nothing was changed.
     """
 
-    ret = {}
-    for led in leds:
-        logging.info(f'Starting sunrise on [{led}]')
-        leds[led].background_sunrise(time_to_full)
-        ret[led] = leds[led].get()
-    return jsonify(ret)
+    operations = request.get_json(silent=True)
+    try:
+        return jsonify(hardware.execute(operations))
+    except ValueError as e:
+        return jsonify({'errors': e.args[0]}), 400
 
 
 @app.route("/schedule", methods=['GET', 'POST', 'DELETE'])
@@ -346,7 +505,7 @@ def schedule():
         200:
           description: Job list returned
     POST:
-      description: Add a new job
+      description: Add a new job. action is tick or a light action (on, off, toggle, rgb, scene, sunrise, sunset), which runs on the devices given by led. With sun (sunrise or sunset) it runs offset minutes (negative for before) from that every day, at latitude and longitude or the lights' own; with freq it runs every freq seconds; otherwise on the cron fields given. scene, duration, red, green and blue are passed to the light action.
       summary: Add a new job
       tags:
         - schedule
@@ -363,21 +522,11 @@ def schedule():
           description: Jobs removed
     """
     if request.method == 'GET':
-        ret = []
-        for job in scheduler.get_jobs():
-            temp_job = { 'id': job.id, 'name': job.name, 'next_run': job.next_run_time }
-            trigger = {}
-            for f in job.trigger.fields:
-                curval = str(f)
-                trigger[f.name] = curval
-            temp_job['trigger'] = trigger
-            ret.append(temp_job)
-        return jsonify(ret)
+        return jsonify(scheduler.get_jobs())
 
     elif request.method == 'POST':
         action = request.values['action']
-        if 'freq' in request.values:
-            frequency = int(request.values['freq'])
+        frequency = request_value('freq', int)
 
         if 'id' in request.values:
             job_id = request.values['id']
@@ -444,26 +593,45 @@ def schedule():
         else:
             jitter = None
 
-        if action == 'tick':
-            job = scheduler.add_job(tick, 'interval', seconds=frequency)
-        elif action == 'on':
-            job = scheduler.add_job(on, 'interval', seconds=frequency)
-        elif action == 'off':
-            job = scheduler.add_job(off, 'interval', seconds=frequency)
-        elif action == 'sunrise':
-            job = scheduler.add_job(sunrise, 'cron', year=year, month=month, day=day, day_of_week=day_of_week, hour=hour, minute=minute, second=second, start_date=start_date, end_date=end_date, timezone=tz , jitter=jitter, replace_existing=True, id=job_id)
-        else:
-            return "I do not know how to do that.\n"
+        # Parameters for the light action, only those given
+        params = {}
+        for (name, kind) in (('scene', str), ('duration', float), ('red', int), ('green', int), ('blue', int)):
+            if name in request.values:
+                params[name] = request_value(name, kind)
+
+        try:
+            if action == 'tick':
+                job = scheduler.add_job(tick, 'interval', seconds=frequency)
+            elif action in light_jobs.actions:
+                args = [action, request_targets(), params]
+                # Fail now, not in the scheduler when the job runs
+                errors = hardware.check(light_jobs.operations(*args))
+                if errors:
+                    raise ValueError(errors)
+                if 'sun' in request.values:
+                    job = scheduler.add_job(light_jobs.run, 'solar', event=request.values['sun'],
+                        offset=request_value('offset', float, 0),
+                        latitude=request_value('latitude', float, latitude),
+                        longitude=request_value('longitude', float, longitude),
+                        timezone=tz, replace_existing=True, id=job_id, args=args, name=action)
+                elif 'freq' in request.values:
+                    job = scheduler.add_job(light_jobs.run, 'interval', seconds=frequency, args=args, name=action)
+                else:
+                    job = scheduler.add_job(light_jobs.run, 'cron', year=year, month=month, day=day, day_of_week=day_of_week, hour=hour, minute=minute, second=second, start_date=start_date, end_date=end_date, timezone=tz , jitter=jitter, replace_existing=True, id=job_id, args=args, name=action)
+            else:
+                return "I do not know how to do that.\n"
+        except ValueError as e:
+            return jsonify({'errors': e.args[0]}), 400
 
-        temp_job = { 'id': job.id, 'name': job.name }
+        temp_job = { 'id': job['id'], 'name': job['name'] }
         return json.dumps(temp_job)
 
     elif request.method == 'DELETE':
         ret = []
         for job in scheduler.get_jobs():
-            temp_job = { 'id': job.id, 'name': job.name }
+            temp_job = { 'id': job['id'], 'name': job['name'] }
             ret.append(temp_job)
-            job.remove()
+            scheduler.remove_job(job['id'])
         return json.dumps(ret)
 
     return "I do not know how to do that.\n"
@@ -491,13 +659,11 @@ def schedules(event_id):
     """
 
     if request.method == 'GET':
-        job = scheduler.get_jobs(event_id)
-        jobdict = {}
-        for f in job.trigger.fields:
-            curval = str(f)
-            jobdict[f.name] = curval
+        job = scheduler.get_job(event_id)
+        if job is None:
+            return jsonify({'errors': [f'no job {event_id!r}']}), 404
 
-        return jsonify(jobdict)
+        return jsonify(job['trigger'])
         return f"GET event with id {event_id}\n"
     elif request.method == 'PUT':
         return f"UPDATE event with id {event_id}\n"
@@ -508,6 +674,116 @@ def schedules(event_id):
 
 
 
+@app.route("/schedule/<event_id>/timeline")
+def timeline(event_id):
+    """
+    When a job will run next.
+    ---
+    tags:
+      - schedule
+    parameters:
+      - in : query
+        name: count
+        description: How many fire times to return (default 10, max 366)
+        required: false
+        type: integer
+    responses:
+      200:
+        description: List of the job's next fire times, ISO 8601
+      404:
+        description: No such job
+    """
+
+    count = min(max(request_value('count', int, 10), 0), max_timeline)
+    try:
+        return jsonify(scheduler.timeline(event_id, count))
+    except ValueError as e:
+        return jsonify({'errors': e.args[0]}), 404
+
+
+@app.route("/metrics")
+def metrics():
+    """
+    Renderer metrics
+    ---
+    tags:
+      - schedule
+    summary: Return the frame count, how late scheduled scenes started and pin writes per device
+    description: Scheduled scenes are armed ahead of time to start exactly when they are due. drift_ms is how far after that their first frame came (count, last, mean and max). writes has, for each device, the pin writes sent and those suppressed because the pin already had that value.
+    responses:
+      200:
+        description: A JSON object with frames, drift_ms and writes
+    """
+
+    return jsonify(hardware.metrics())
+
+
+# ============================================================
+# Request parameters
+
+# The devices and groups, fetched on first use. They never change
+# while running.
+described = None
+
+
+def devices():
+    """
+    Return the devices and groups, as hardware.describe() does.
+    """
+
+    global described
+    if described is None:
+        described = hardware.describe()
+    return described
+
+
+def device_names(names):
+    """
+    Return the device names in a list of device and group names.
+    """
+
+    leds = []
+    for name in names:
+        for led in [name] if name in devices()['leds'] else devices()['groups'][name]:
+            if led not in leds:
+                leds.append(led)
+    return leds
+
+
+def request_targets():
+    """
+    Return the device and group names the current request is for.
+
+    These come from the led parameters, 'all' if there are none.
+    An unknown name ends the request with a 404.
+    """
+
+    names = [name for value in request.values.getlist('led') for name in value.split(',') if name]
+    if not names:
+        return ['all']
+    for name in names:
+        if name not in devices()['leds'] and name not in devices()['groups']:
+            abort(Response(json.dumps({'errors': [f'unknown led {name!r}']}), 404, mimetype='application/json'))
+    return names
+
+
+def request_value(name, kind, default = None):
+    """
+    Return the request parameter name converted with kind, or default
+    if it is not given.
+
+    A value kind can not convert ends the request with a 400.
+    """
+
+    if name not in request.values:
+        return default
+    try:
+        return kind(request.values[name])
+    except ValueError:
+        error = f'{name} must be {kind.__name__}, not {request.values[name]!r}'
+        abort(Response(json.dumps({'errors': [error]}), 400, mimetype='application/json'))
+
+
 # ============================================================
 # Basic do nothing unit of work
 
@@ -536,6 +812,9 @@ def noop():
 # ============================================================
 # Create the scheduler. 
 # 
+# Only one process on the host runs it: whichever API worker wins
+# the election in job_scheduler. The others send it their jobs.
+#
 # The initial noop job is top force the scheduler to load the
 # jobstore from disk.
 #
@@ -543,12 +822,39 @@ def noop():
 # and can be removed when I am satisfied with the functionality
 # of this system.
 #
- 
-scheduler = BackgroundScheduler(jobstores=jobstores, executors=executors, job_defaults=job_defaults, timezone='America/Los_Angeles')
 
-logging.info('')
-scheduler.add_job(noop)
+def create_scheduler():
+    """
+    Make the real scheduler. job_scheduler calls this in the leader.
+    """
+
+    scheduler = BackgroundScheduler(jobstores=jobstores, executors=executors, job_defaults=job_defaults, timezone='America/Los_Angeles')
+    scheduler.add_listener(lambda event: migrate_jobs(scheduler), EVENT_SCHEDULER_STARTED)
+    scheduler.add_job(noop)
+    return scheduler
+
 
+# Jobs saved when the scheduler ran the view functions, and the light
+# action each did. They used no request parameters, so were for 'all'.
+legacy_jobs = {f'api_server:{action}': action for action in ('on', 'off', 'toggle', 'sunrise')}
+
+
+def migrate_jobs(scheduler):
+    """
+    Point saved jobs that still run a view function at light_jobs.run,
+    which needs no request. Run once the jobstore is loaded.
+    """
+
+    for job in scheduler.get_jobs():
+        action = legacy_jobs.get(job.func_ref)
+        if action is not None:
+            logging.info(f'Moving job {job.id} from {job.func_ref} to light_jobs.run')
+            job.modify(func=light_jobs.run, args=[action, 'all', {}], kwargs={})
+
+
+scheduler = job_scheduler(create_scheduler, preroll=light_jobs.preroll, cancel_preroll=light_jobs.unarm)
+
+logging.info('')
 logging.info('------------------------------------------------------------')
 
 scheduler.start()
@@ -0,0 +1,388 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# async_pigpio.py
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+An asyncio client for the pigpio daemon socket, with pipelining.
+
+pigpiod answers the commands on a socket in the order they were sent,
+so there is no need to wait for one reply before sending the next.
+Every async_pi command writes its request straight away and returns a
+future for the reply. Send as many as you like, then await them:
+
+    pi = async_pi()
+    await pi.connect()
+    replies = [pi.set_PWM_dutycycle(gpio, 0) for gpio in (2, 3, 4)]
+    await asyncio.gather(*replies)
+
+loop_pi wraps an async_pi on its own event loop thread and takes the
+same blocking calls as a pigpio.pi, so a led_strip can use it as its
+pi. Its writes do not wait for a reply at all. It connects on the
+first call, not when it is made, and connects again whenever the
+connection is lost, backing off while pigpiod can not be reached.
+
+Only the commands this project uses are implemented.
+See http://abyz.me.uk/rpi/pigpio/sif.html
+"""
+
+import os
+import atexit
+import struct
+import asyncio
+import logging
+import threading
+import pigpio
+import concurrent.futures
+
+
+# Socket command numbers
+CMD_MODES = 0
+CMD_PWM = 5
+CMD_PRS = 6
+CMD_PRG = 22
+CMD_PROC = 38
+CMD_PROCD = 39
+CMD_PROCR = 40
+CMD_PROCS = 41
+CMD_PROCP = 45
+CMD_GDC = 83
+CMD_FG = 97
+
+
+class async_pi:
+    """
+    A pipelined connection to the pigpio daemon.
+    """
+
+    # Seconds before trying again after a failed connection, doubled
+    # on each failure up to max_backoff
+    backoff = 0.5
+    max_backoff = 30
+
+    def __init__(self, host = None, port = None):
+        """
+        None uses the pigpio defaults (PIGPIO_ADDR or localhost and
+        PIGPIO_PORT or 8888).
+        """
+
+        self.host = host or os.getenv('PIGPIO_ADDR', 'localhost')
+        self.port = int(port or os.getenv('PIGPIO_PORT', 8888))
+        self.reader = None
+        self.writer = None
+        self.replies = None
+        self.reply_task = None
+        self.connected = False
+        self.connecting = None
+        self.retry_at = 0
+        self.delay = self.backoff
+
+
+    async def connect(self):
+        """
+        Open the connection and start reading replies.
+        """
+
+        (self.reader, self.writer) = await asyncio.open_connection(self.host, self.port)
+        self.replies = asyncio.Queue()
+        self.reply_task = asyncio.ensure_future(self.read_replies())
+        self.connected = True
+
+
+    async def ensure_connected(self):
+        """
+        Connect if not connected.
+
+        After a failed attempt the next is not made for a backoff that
+        doubles with each failure; until then this raises pigpio.error
+        straight away.
+        """
+
+        if self.connected:
+            return
+        if self.connecting is None:
+            self.connecting = asyncio.Lock()
+
+        async with self.connecting:
+            if self.connected:
+                return
+            now = asyncio.get_event_loop().time()
+            if now < self.retry_at:
+                raise pigpio.error('not connected to pigpio')
+            try:
+                await self.connect()
+            except OSError as e:
+                logging.warning(f'Unable to connect to pigpio at {self.host}:{self.port}: {e}, '
+                                f'trying again in {self.delay:g} s')
+                self.retry_at = now + self.delay
+                self.delay = min(self.delay * 2, self.max_backoff)
+                raise pigpio.error(f'not connected to pigpio: {e}')
+            logging.info(f'Connected to pigpio at {self.host}:{self.port}')
+            self.delay = self.backoff
+
+
+    async def close(self):
+        """
+        Close the connection. Unanswered commands get an error.
+        """
+
+        self.connected = False
+        if self.writer is not None:
+            self.writer.close()
+            await asyncio.gather(self.writer.wait_closed(), return_exceptions=True)
+        if self.reply_task is not None:
+            await asyncio.gather(self.reply_task, return_exceptions=True)
+
+
+    def command(self, cmd, p1 = 0, p2 = 0, extension = b'', extra = False):
+        """
+        Send a command and return a future for its result.
+
+        extension is sent after the command as its p3 data. With extra
+        set the reply is followed by that many bytes of data, and the
+        future gets (result, data).
+        """
+
+        if not self.connected:
+            raise pigpio.error('not connected to pigpio')
+
+        future = asyncio.get_event_loop().create_future()
+        self.replies.put_nowait((future, extra))
+        self.writer.write(struct.pack('IIII', cmd, p1, p2, len(extension)) + extension)
+        return future
+
+
+    async def read_replies(self):
+        """
+        Match the replies coming back to the futures, in order.
+        """
+
+        try:
+            while True:
+                data = await self.reader.readexactly(16)
+                (future, extra) = self.replies.get_nowait()
+                (cmd, p1, p2, result) = struct.unpack('IIIi', data)
+
+                if extra and result > 0:
+                    data = await self.reader.readexactly(result)
+                    result = (result, data)
+
+                if future.cancelled():
+                    continue
+                if isinstance(result, int) and result < 0:
+                    future.set_exception(pigpio.error(pigpio.error_text(result)))
+                else:
+                    future.set_result(result)
+        except (asyncio.IncompleteReadError, OSError, asyncio.QueueEmpty) as e:
+            if self.connected:
+                logging.warning(f'Lost the pigpio connection: {e}')
+            self.connected = False
+            self.writer.close()
+            while not self.replies.empty():
+                (future, extra) = self.replies.get_nowait()
+                if not future.done():
+                    future.set_exception(pigpio.error(f'pigpio connection lost: {e}'))
+
+
+    def set_mode(self, gpio, mode):
+        return self.command(CMD_MODES, gpio, mode)
+
+
+    def set_glitch_filter(self, gpio, steady):
+        return self.command(CMD_FG, gpio, steady)
+
+
+    def set_PWM_dutycycle(self, gpio, dutycycle):
+        return self.command(CMD_PWM, gpio, int(dutycycle))
+
+
+    def get_PWM_dutycycle(self, gpio):
+        return self.command(CMD_GDC, gpio)
+
+
+    def set_PWM_range(self, gpio, range_):
+        return self.command(CMD_PRS, gpio, range_)
+
+
+    def get_PWM_range(self, gpio):
+        return self.command(CMD_PRG, gpio)
+
+
+    def store_script(self, script):
+        return self.command(CMD_PROC, extension=script)
+
+
+    def run_script(self, script_id, params = None):
+        extension = b''.join(struct.pack('I', p) for p in params or ())
+        return self.command(CMD_PROCR, script_id, extension=extension)
+
+
+    async def script_status(self, script_id):
+        """
+        Return (status, params) like pigpio.pi.script_status.
+        """
+
+        result = await self.command(CMD_PROCP, script_id, extra=True)
+        if isinstance(result, int):
+            return (result, ())
+        pars = struct.unpack('11i', result[1])
+        return (pars[0], pars[1:])
+
+
+    def stop_script(self, script_id):
+        return self.command(CMD_PROCS, script_id)
+
+
+    def delete_script(self, script_id):
+        return self.command(CMD_PROCD, script_id)
+
+
+class loop_pi:
+    """
+    Blocking pigpio.pi style calls on an async_pi.
+
+    The async_pi runs on an event loop in a thread of its own. Calls
+    that read something wait for the reply. set_PWM_dutycycle and
+    set_PWM_range are only queued; they are pipelined behind each other
+    and any error they get is logged. Queued calls made while connecting
+    are sent, in order, once connected, or dropped if that fails.
+    """
+
+    # Calls that are sent without waiting for the reply
+    no_wait = ('set_PWM_dutycycle', 'set_PWM_range')
+
+    # Longest stop() waits for the connection to close, in seconds
+    stop_timeout = 2
+
+    def __init__(self, host = None, port = None):
+        self.stopped = False
+        self.stop_lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.pi = async_pi(host, port)
+        # Queued calls waiting for a connection, and the task making it
+        self.pending = []
+        self.connect_task = None
+        atexit.register(self.stop)
+
+
+    @property
+    def connected(self):
+        return self.pi.connected
+
+
+    def wait(self, coro):
+        """
+        Run a coroutine on the loop and return its result.
+        """
+
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+    def stop(self):
+        """
+        Close the connection and stop the loop.
+
+        Only the first call does anything, so it is safe to call as
+        well as the atexit hook. Waits at most stop_timeout seconds.
+        """
+
+        with self.stop_lock:
+            if self.stopped:
+                return
+            self.stopped = True
+
+        if self.loop.is_running():
+            close = asyncio.run_coroutine_threadsafe(self.pi.close(), self.loop)
+            try:
+                close.result(timeout=self.stop_timeout)
+            except concurrent.futures.TimeoutError:
+                logging.warning('Timed out closing the pigpio connection')
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(self.stop_timeout)
+
+
+    def batch(self, calls):
+        """
+        Pipeline (method name, args) calls and return their results.
+
+        All the calls are sent before any reply is awaited. A call that
+        fails gives its exception as the result.
+        """
+
+        async def run():
+            try:
+                await self.pi.ensure_connected()
+            except pigpio.error as e:
+                return [e] * len(calls)
+            replies = [getattr(self.pi, name)(*args) for (name, args) in calls]
+            return await asyncio.gather(*replies, return_exceptions=True)
+
+        return self.wait(run())
+
+
+    def __getattr__(self, name):
+        """
+        Wrap an async_pi command as a blocking call.
+        """
+
+        method = getattr(async_pi, name, None)
+        if method is None or name.startswith('_'):
+            raise AttributeError(name)
+
+        async def run(*args):
+            await self.pi.ensure_connected()
+            return await getattr(self.pi, name)(*args)
+
+        if name in self.no_wait:
+            def call(*args):
+                self.loop.call_soon_threadsafe(self.send, name, args)
+        else:
+            def call(*args):
+                return self.wait(run(*args))
+
+        setattr(self, name, call)
+        return call
+
+
+    def send(self, name, args):
+        """
+        Send a command from the loop thread without waiting for it.
+        """
+
+        if not self.pi.connected or self.pending:
+            self.pending.append((name, args))
+            if self.connect_task is None or self.connect_task.done():
+                self.connect_task = asyncio.ensure_future(self.send_pending())
+            return
+
+        def check(future):
+            if not future.cancelled() and future.exception() is not None:
+                logging.warning(f'pigpio {name}{args} failed: {future.exception()}')
+
+        try:
+            getattr(self.pi, name)(*args).add_done_callback(check)
+        except pigpio.error as e:
+            logging.warning(f'pigpio {name}{args} failed: {e}')
+
+
+    async def send_pending(self):
+        """
+        Connect, then send the calls queued meanwhile in order. They
+        are dropped if pigpio can not be reached.
+        """
+
+        try:
+            await self.pi.ensure_connected()
+        except pigpio.error:
+            # ensure_connected logged why
+            self.pending.clear()
+            return
+
+        (pending, self.pending) = (self.pending, [])
+        for (name, args) in pending:
+            self.send(name, args)
@@ -0,0 +1,393 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# bench.py
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+Benchmarks for the led strip hot paths, run against fake_pigpio.
+
+Measures fade and sunrise timing accuracy, frame jitter and pigpio
+calls per transition for each way of running them, action start and
+stop latency, API route latency under concurrency and scheduler
+dispatch delay. Results are written as JSON so runs can be compared:
+
+    python bench.py --output before.json
+    ... change things ...
+    python bench.py --output after.json --compare before.json
+
+The API and scheduler benchmarks import api_server with the fake
+backend, from a scratch directory so the real jobs.sqlite is left alone.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import statistics
+import subprocess
+
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+# Must be set before led_strip is imported by api_server
+os.environ.setdefault('LED_BACKEND', 'fake')
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+
+from fake_pigpio import fake_pi
+from led_strip import led_strip
+from renderer import renderer
+
+
+# ============================================================
+# Helpers
+
+def percentile(values, p):
+    """
+    Return the p'th percentile (0-100) of values.
+    """
+
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summary(values, scale = 1000):
+    """
+    Return mean/p50/p99/max of values, times scale (seconds to ms).
+    """
+
+    if not values:
+        return {}
+    return {
+        'count': len(values),
+        'mean': statistics.mean(values) * scale,
+        'p50': percentile(values, 50) * scale,
+        'p99': percentile(values, 99) * scale,
+        'max': max(values) * scale,
+    }
+
+
+def frame_times(writes, gap = 0.002):
+    """
+    Group recorded writes into frames, return the frame start times.
+
+    Writes closer together than gap seconds are one frame.
+    """
+
+    frames = []
+    for (t, gpio, duty) in writes:
+        if not frames or t - last > gap:
+            frames.append(t)
+        last = t
+    return frames
+
+
+def frame_jitter(writes, fps):
+    """
+    Return how far frame intervals stray from 1/fps, in ms.
+    """
+
+    frames = frame_times(writes)
+    intervals = [b - a for (a, b) in zip(frames, frames[1:])]
+    if not intervals:
+        return {}
+
+    # Skipped frames (no color change) show up as whole multiples
+    period = 1 / fps
+    errors = [abs(i - max(1, round(i / period)) * period) for i in intervals]
+    return {'frames': len(frames), 'p50': percentile(errors, 50) * 1000, 'p99': percentile(errors, 99) * 1000}
+
+
+def wait_idle(strip, timeout = 60):
+    """
+    Wait for a strip's background action to end.
+    """
+
+    end = time.monotonic() + timeout
+    while strip.active() and time.monotonic() < end:
+        time.sleep(0.001)
+
+
+# ============================================================
+# Transitions
+
+def make_strip(pi, mode, fade_duration, fps):
+    """
+    Return a strip set up to run transitions in the given mode.
+    """
+
+    strip = led_strip(2, 3, 4, 255, fade_duration=fade_duration, fps=fps, pi=pi)
+    if mode == 'stepped':
+        strip.fps = 0
+    elif mode == 'script':
+        strip.use_scripts = True
+    elif mode == 'renderer':
+        renderer(fps).register(strip)
+    strip.setup()
+    return strip
+
+
+def bench_fades(args):
+    """
+    Fade full off to full on in each mode.
+    """
+
+    results = {}
+    for mode in ('stepped', 'timed', 'script', 'renderer'):
+        pi = fake_pi(latency=args.latency)
+        strip = make_strip(pi, mode, args.fade, args.fps)
+        pi.reset()
+        before = strip.write_stats()
+
+        begin = time.monotonic()
+        strip.background_fade(0, 0, 0)
+        wait_idle(strip)
+        wall = time.monotonic() - begin
+
+        results[mode] = {
+            'wall': wall,
+            'error_ms': (wall - args.fade) * 1000,
+            'calls': sum(pi.calls.values()),
+            'writes': len(pi.writes),
+            'pin_writes': {k: v - before[k] for (k, v) in strip.write_stats().items()},
+            'jitter_ms': frame_jitter(pi.writes, args.fps),
+            'correct': strip.get() == (0, 0, 0),
+        }
+    return results
+
+
+def bench_sunrise(args):
+    """
+    Run a short sunrise in each mode.
+    """
+
+    results = {}
+    for mode in ('timed', 'script', 'renderer'):
+        pi = fake_pi(latency=args.latency)
+        strip = make_strip(pi, mode, args.fade, args.fps)
+        pi.reset()
+        before = strip.write_stats()
+
+        begin = time.monotonic()
+        strip.background_sunrise(args.sunrise)
+        wait_idle(strip)
+        wall = time.monotonic() - begin
+
+        results[mode] = {
+            'wall': wall,
+            'error_ms': (wall - args.sunrise) * 1000,
+            'calls': sum(pi.calls.values()),
+            'writes': len(pi.writes),
+            'pin_writes': {k: v - before[k] for (k, v) in strip.write_stats().items()},
+            'jitter_ms': frame_jitter(pi.writes, args.fps),
+        }
+    return results
+
+
+def bench_actions(args):
+    """
+    Time starting and stopping a fade.
+    """
+
+    results = {}
+    for mode in ('timed', 'renderer'):
+        pi = fake_pi(latency=args.latency)
+        strip = make_strip(pi, mode, 10, args.fps)
+        starts = []
+        stops = []
+        for i in range(args.repeat):
+            begin = time.perf_counter()
+            strip.background_fade(i % 256, 0, 0)
+            starts.append(time.perf_counter() - begin)
+
+            begin = time.perf_counter()
+            strip.stop_fade()
+            stops.append(time.perf_counter() - begin)
+
+        results[mode] = {'start_ms': summary(starts), 'stop_ms': summary(stops)}
+    return results
+
+
+# ============================================================
+# API and scheduler
+
+def import_api_server():
+    """
+    Import api_server from a scratch directory, return the module.
+    """
+
+    os.chdir(tempfile.mkdtemp(prefix='led_bench_'))
+    logging.disable(logging.INFO)
+    import api_server
+    return api_server
+
+
+def bench_api(args, api_server):
+    """
+    Hit the API routes from many threads at once.
+    """
+
+    results = {}
+    routes = {
+        'state': lambda i: '/state',
+        'rgb': lambda i: f'/rgb?red={i % 256}&green=0&blue=0',
+        'toggle': lambda i: '/toggle',
+    }
+
+    for (name, url) in routes.items():
+        times = []
+        lock = threading.Lock()
+
+        def worker(n):
+            client = api_server.app.test_client()
+            mine = []
+            for i in range(args.requests):
+                begin = time.perf_counter()
+                response = client.get(url(n * args.requests + i))
+                mine.append(time.perf_counter() - begin)
+                if response.status_code >= 400:
+                    raise RuntimeError(f'{url(i)} returned {response.status_code}')
+            with lock:
+                times.extend(mine)
+
+        begin = time.perf_counter()
+        with ThreadPoolExecutor(args.clients) as pool:
+            list(pool.map(worker, range(args.clients)))
+        wall = time.perf_counter() - begin
+
+        results[name] = {'latency_ms': summary(times), 'requests_per_second': len(times) / wall}
+    return results
+
+
+# Times scheduled jobs actually ran, filled in by dispatched()
+dispatches = []
+
+
+def dispatched(scheduled):
+    """
+    Scheduler job: record how late it ran.
+    """
+
+    dispatches.append(time.time() - scheduled)
+
+
+def bench_scheduler(args, api_server):
+    """
+    Schedule date jobs a little in the future and time how late they run.
+    """
+
+    del dispatches[:]
+    start = time.time() + 0.5
+    for i in range(args.jobs):
+        when = start + i * 0.05
+        api_server.scheduler.add_job(dispatched, 'date', run_date=datetime.fromtimestamp(when, timezone.utc),
+            args=[when], id=f'bench_{i}', replace_existing=True)
+
+    end = time.monotonic() + 5 + args.jobs * 0.05
+    while len(dispatches) < args.jobs and time.monotonic() < end:
+        time.sleep(0.01)
+
+    return {'dispatch_delay_ms': summary(dispatches), 'missed': args.jobs - len(dispatches)}
+
+
+# ============================================================
+# Reporting
+
+def flatten(results, prefix = ''):
+    """
+    Return {'a.b.c': number} for every number in nested results.
+    """
+
+    flat = {}
+    for (key, value) in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+def compare(old, new):
+    """
+    Print every number that changed between two result files.
+    """
+
+    old = flatten(old['results'])
+    new = flatten(new['results'])
+    for key in sorted(new):
+        if key not in old:
+            continue
+        (a, b) = (old[key], new[key])
+        change = f'{(b - a) / abs(a) * 100:+.1f}%' if a else ''
+        print(f'{key:60} {a:12.3f} {b:12.3f} {change}')
+
+
+def revision():
+    """
+    Return the git commit being benchmarked, if there is one.
+    """
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=here, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the led strip hot paths')
+    parser.add_argument('--output', default='bench.json', help='file to write results to')
+    parser.add_argument('--compare', help='earlier results file to compare with')
+    parser.add_argument('--latency', type=float, default=0.0002, help='fake pigpio seconds per call')
+    parser.add_argument('--fade', type=float, default=1.0, help='fade_duration in seconds')
+    parser.add_argument('--sunrise', type=float, default=3.0, help='sunrise duration in seconds')
+    parser.add_argument('--fps', type=int, default=30)
+    parser.add_argument('--repeat', type=int, default=200, help='action starts and stops to time')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent API clients')
+    parser.add_argument('--requests', type=int, default=50, help='requests per API client')
+    parser.add_argument('--jobs', type=int, default=20, help='scheduler jobs to time')
+    parser.add_argument('--skip-api', action='store_true', help='skip the API and scheduler benchmarks')
+    args = parser.parse_args(argv[1:])
+    output = os.path.abspath(args.output)
+    earlier = os.path.abspath(args.compare) if args.compare else None
+
+    results = {}
+    results['fade'] = bench_fades(args)
+    results['sunrise'] = bench_sunrise(args)
+    results['actions'] = bench_actions(args)
+    if not args.skip_api:
+        api_server = import_api_server()
+        results['api'] = bench_api(args, api_server)
+        results['scheduler'] = bench_scheduler(args, api_server)
+
+    run = {
+        'meta': {
+            'time': datetime.now().isoformat(),
+            'revision': revision(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+    with open(output, 'w') as f:
+        json.dump(run, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+    if earlier:
+        with open(earlier) as f:
+            compare(json.load(f), run)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -26,6 +26,7 @@ This might be if/when additional buttons get added to the system.
 import sys
 import time
 import pigpio
+import pigpio_pool
 import requests
 import logging
 
@@ -43,7 +44,7 @@ def do_watcher():
     Watch for button pushes and respond with http API calls."
     """
 
-    pi = pigpio.pi()
+    pi = pigpio_pool.pi()
     if not pi.connected:
            exit()
 
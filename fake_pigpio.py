@@ -0,0 +1,325 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# fake_pigpio.py
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+An in-memory stand in for pigpio.pi, for testing and benchmarking
+without a Raspberry Pi.
+
+fake_pi takes the pigpio.pi calls this project uses (the led strip
+backend interface, see led_strip) and keeps the pins in memory.
+Every PWM write is recorded with a monotonic timestamp, every call is
+counted, and each call can be made to take a set time to mimic the
+round trip to pigpiod. Scripts from pigpio_script are run by a small
+interpreter on a thread, so script mode can be measured too.
+
+Use it by giving it to a strip, or for every strip with the
+LED_BACKEND=fake environment variable:
+
+    pi = fake_pi(latency=0.0002)
+    strip = led_strip(2, 3, 4, 255, pi=pi)
+"""
+
+import time
+import random
+import logging
+import threading
+import pigpio
+
+
+class fake_pi:
+    """
+    In-memory pigpio.pi with recorded writes and optional latency.
+    """
+
+    def __init__(self, latency = 0, jitter = 0):
+        """
+        Each call sleeps latency seconds plus up to jitter seconds more.
+        """
+
+        self.latency = latency
+        self.jitter = jitter
+        self.connected = True
+        self.lock = threading.Lock()
+
+        self.modes = {}
+        self.ranges = {}
+        self.duty = {}
+        self.filters = {}
+        self.callbacks = []
+        self.scripts = {}
+
+        # (monotonic time, gpio, dutycycle) for every PWM write
+        self.writes = []
+        # Number of calls made, by method name
+        self.calls = {}
+
+
+    def reset(self):
+        """
+        Forget the recorded writes and call counts.
+        """
+
+        with self.lock:
+            self.writes = []
+            self.calls = {}
+
+
+    def call(self, name):
+        """
+        Count a call and wait out the configured latency.
+        """
+
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        delay = self.latency
+        if self.jitter:
+            delay += random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+
+    def stop(self):
+        self.connected = False
+
+
+    def set_mode(self, gpio, mode):
+        self.call('set_mode')
+        self.modes[gpio] = mode
+        return 0
+
+
+    def get_mode(self, gpio):
+        self.call('get_mode')
+        return self.modes.get(gpio, pigpio.INPUT)
+
+
+    def set_glitch_filter(self, gpio, steady):
+        self.call('set_glitch_filter')
+        self.filters[gpio] = steady
+        return 0
+
+
+    def set_PWM_range(self, gpio, range_):
+        self.call('set_PWM_range')
+        self.ranges[gpio] = range_
+        return 0
+
+
+    def get_PWM_range(self, gpio):
+        self.call('get_PWM_range')
+        return self.ranges.get(gpio, 255)
+
+
+    def set_PWM_dutycycle(self, gpio, dutycycle):
+        self.call('set_PWM_dutycycle')
+        self.write(gpio, int(dutycycle))
+        return 0
+
+
+    def get_PWM_dutycycle(self, gpio):
+        self.call('get_PWM_dutycycle')
+        if gpio not in self.duty:
+            raise pigpio.error('GPIO is not in use for PWM')
+        return self.duty[gpio]
+
+
+    def write(self, gpio, dutycycle):
+        """
+        Set and record a PWM write.
+        """
+
+        with self.lock:
+            self.duty[gpio] = dutycycle
+            self.modes[gpio] = pigpio.OUTPUT
+            self.writes.append((time.monotonic(), gpio, dutycycle))
+
+
+    def callback(self, gpio, edge = pigpio.RISING_EDGE, func = None):
+        """
+        Register a level change callback. Use trigger() to fire it.
+        """
+
+        self.call('callback')
+        cb = fake_callback(self, gpio, edge, func)
+        self.callbacks.append(cb)
+        return cb
+
+
+    def trigger(self, gpio, level = 1):
+        """
+        Act as if gpio changed to level, calling matching callbacks.
+        """
+
+        tick = int(time.monotonic() * 1000000) & 0xffffffff
+        for cb in list(self.callbacks):
+            if cb.gpio != gpio:
+                continue
+            # Same test pigpio uses: RISING_EDGE is 0, FALLING_EDGE 1
+            if cb.edge == pigpio.EITHER_EDGE or cb.edge ^ level:
+                cb.func(gpio, level, tick)
+
+
+    def store_script(self, script):
+        self.call('store_script')
+        with self.lock:
+            sid = len(self.scripts)
+            while sid in self.scripts:
+                sid += 1
+            self.scripts[sid] = fake_script(self, script)
+        return sid
+
+
+    def run_script(self, script_id, params = None):
+        self.call('run_script')
+        self.script(script_id).run()
+        return 0
+
+
+    def script_status(self, script_id):
+        self.call('script_status')
+        script = self.script(script_id)
+        return (script.status, script.params)
+
+
+    def stop_script(self, script_id):
+        self.call('stop_script')
+        self.script(script_id).stop()
+        return 0
+
+
+    def delete_script(self, script_id):
+        self.call('delete_script')
+        self.script(script_id).stop()
+        with self.lock:
+            del self.scripts[script_id]
+        return 0
+
+
+    def script(self, script_id):
+        if script_id not in self.scripts:
+            raise pigpio.error('unknown script id')
+        return self.scripts[script_id]
+
+
+class fake_callback:
+    """
+    What fake_pi.callback returns.
+    """
+
+    def __init__(self, pi, gpio, edge, func):
+        self.pi = pi
+        self.gpio = gpio
+        self.edge = edge
+        self.func = func or self.tally_edge
+        self.count = 0
+
+
+    def tally_edge(self, gpio, level, tick):
+        self.count += 1
+
+
+    def tally(self):
+        return self.count
+
+
+    def cancel(self):
+        if self in self.pi.callbacks:
+            self.pi.callbacks.remove(self)
+
+
+class fake_script:
+    """
+    Runs the part of the pigpio script language pigpio_script writes.
+    """
+
+    def __init__(self, pi, text):
+        self.pi = pi
+        self.words = text.decode().split()
+        self.status = pigpio.PI_SCRIPT_HALTED
+        self.params = (0,) * 10
+        self.halt = threading.Event()
+        self.thread = None
+
+
+    def run(self):
+        self.stop()
+        self.halt.clear()
+        self.status = pigpio.PI_SCRIPT_RUNNING
+        self.thread = threading.Thread(target=self.execute, daemon=True)
+        self.thread.start()
+
+
+    def stop(self):
+        self.halt.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+
+    def execute(self):
+        """
+        Interpret the script until it ends or is stopped.
+        """
+
+        words = self.words
+        tags = {}
+        for i in range(len(words) - 1):
+            if words[i] == 'tag':
+                tags[words[i + 1]] = i + 2
+
+        v = {}
+        a = 0
+        i = 0
+
+        def value(word):
+            return v.get(word, 0) if word.startswith('v') else int(word)
+
+        try:
+            while i < len(words) and not self.halt.is_set():
+                op = words[i]
+                if op == 'tag':
+                    i += 2
+                elif op == 'ld':
+                    v[words[i + 1]] = value(words[i + 2])
+                    i += 3
+                elif op == 'lda':
+                    a = value(words[i + 1])
+                    i += 2
+                elif op == 'sta':
+                    v[words[i + 1]] = a
+                    i += 2
+                elif op == 'add':
+                    a += value(words[i + 1])
+                    i += 2
+                elif op == 'sub':
+                    a -= value(words[i + 1])
+                    i += 2
+                elif op == 'div':
+                    a = int(a / value(words[i + 1]))
+                    i += 2
+                elif op == 'dcr':
+                    v[words[i + 1]] = v.get(words[i + 1], 0) - 1
+                    i += 2
+                elif op == 'jnz':
+                    i = tags[words[i + 1]] if a != 0 else i + 2
+                elif op == 'pwm':
+                    self.pi.write(int(words[i + 1]), value(words[i + 2]))
+                    i += 3
+                elif op == 'mics':
+                    self.halt.wait(value(words[i + 1]) / 1000000)
+                    i += 2
+                elif op == 'mils':
+                    self.halt.wait(value(words[i + 1]) / 1000)
+                    i += 2
+                else:
+                    raise ValueError(f'unsupported script command {op}')
+        except Exception:
+            logging.exception('fake script failed')
+            self.status = pigpio.PI_SCRIPT_FAILED
+            return
+
+        self.status = pigpio.PI_SCRIPT_HALTED
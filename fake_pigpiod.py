@@ -0,0 +1,231 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# fake_pigpiod.py
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+A stand in pigpio daemon for load testing off the Raspberry Pi.
+
+This listens on the pigpiod socket and speaks enough of its protocol
+for this project: PWM range and duty cycle, pin modes and levels,
+glitch filters, scripts, and the notification socket pigpio uses for
+callbacks. Pins are kept in a fake_pigpio.fake_pi. Every command is
+logged, and each can be delayed to mimic a busy Pi.
+
+    python fake_pigpiod.py --port 8888 --latency 0.0005 --jitter 0.001
+
+Then run api_server.py, buttons.py or monitor.py as normal. Writing a
+level to a pin (pigs w 13 1, or pi.write(13, 1)) is reported to
+callbacks, which is how to press a button.
+
+See http://abyz.me.uk/rpi/pigpio/sif.html
+"""
+
+import sys
+import time
+import random
+import struct
+import asyncio
+import logging
+import argparse
+import pigpio
+
+from fake_pigpio import fake_pi
+
+
+# Socket command numbers handled here, and their names for the log
+COMMANDS = {
+    0: 'MODES', 1: 'MODEG', 3: 'READ', 4: 'WRITE', 5: 'PWM', 6: 'PRS',
+    10: 'BR1', 16: 'TICK', 17: 'HWVER', 19: 'NB', 21: 'NC', 22: 'PRG',
+    26: 'PIGPV', 38: 'PROC', 39: 'PROCD', 40: 'PROCR', 41: 'PROCS',
+    45: 'PROCP', 83: 'GDC', 97: 'FG', 99: 'NOIB',
+}
+
+
+class fake_pigpiod:
+    """
+    The daemon: pin state, notification handles and client sockets.
+    """
+
+    def __init__(self, latency = 0, jitter = 0):
+        """
+        Each command is answered after latency seconds plus up to
+        jitter seconds more.
+        """
+
+        self.latency = latency
+        self.jitter = jitter
+        self.pi = fake_pi()
+        self.start = time.monotonic()
+        self.levels = 0
+        self.handles = {}
+        self.commands = 0
+
+
+    def tick(self):
+        """
+        Microseconds since start, wrapping like the pigpio tick.
+        """
+
+        return int((time.monotonic() - self.start) * 1000000) & 0xffffffff
+
+
+    async def client(self, reader, writer):
+        """
+        Serve one client socket until it closes.
+        """
+
+        peer = writer.get_extra_info('peername')
+        logging.info(f'Client connected {peer}')
+        try:
+            while True:
+                (cmd, p1, p2, p3) = struct.unpack('IIII', await reader.readexactly(16))
+                extension = await reader.readexactly(p3) if p3 else b''
+
+                if cmd == 21 and p1 in self.handles and self.handles[p1][0] is writer:
+                    # NC on a notification socket closes it, no reply
+                    logging.info(f'NC {p1}')
+                    del self.handles[p1]
+                    break
+
+                delay = self.latency
+                if self.jitter:
+                    delay += random.uniform(0, self.jitter)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                (result, data) = self.command(cmd, p1, p2, extension, writer)
+                self.commands += 1
+                logging.info(f'{COMMANDS.get(cmd, cmd)} {p1} {p2} {len(extension)} -> {result}')
+                writer.write(struct.pack('IIIi', cmd, p1, p2, result) + data)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for handle in [h for (h, (w, bits)) in self.handles.items() if w is writer]:
+                del self.handles[handle]
+            writer.close()
+            logging.info(f'Client disconnected {peer}')
+
+
+    def command(self, cmd, p1, p2, extension, writer):
+        """
+        Run a command and return (result, extra reply data).
+        """
+
+        pi = self.pi
+        try:
+            if cmd == 0:
+                return (pi.set_mode(p1, p2), b'')
+            if cmd == 1:
+                return (pi.get_mode(p1), b'')
+            if cmd == 3:
+                return ((self.levels >> p1) & 1, b'')
+            if cmd == 4:
+                self.level(p1, p2)
+                return (0, b'')
+            if cmd == 5:
+                return (pi.set_PWM_dutycycle(p1, p2), b'')
+            if cmd == 6:
+                pi.set_PWM_range(p1, p2)
+                return (p2, b'')
+            if cmd == 10:
+                return (self.levels, b'')
+            if cmd == 16:
+                return (self.tick(), b'')
+            if cmd == 17:
+                return (0xa02082, b'')
+            if cmd == 19:
+                if p1 not in self.handles:
+                    return (pigpio.PI_BAD_HANDLE, b'')
+                self.handles[p1][1] = p2
+                return (0, b'')
+            if cmd == 21:
+                self.handles.pop(p1, None)
+                return (0, b'')
+            if cmd == 22:
+                return (pi.get_PWM_range(p1), b'')
+            if cmd == 26:
+                return (79, b'')
+            if cmd == 38:
+                return (pi.store_script(extension), b'')
+            if cmd == 39:
+                return (pi.delete_script(p1), b'')
+            if cmd == 40:
+                return (pi.run_script(p1), b'')
+            if cmd == 41:
+                return (pi.stop_script(p1), b'')
+            if cmd == 45:
+                (status, params) = pi.script_status(p1)
+                data = struct.pack('11i', status, *params)
+                return (len(data), data)
+            if cmd == 83:
+                return (pi.get_PWM_dutycycle(p1), b'')
+            if cmd == 97:
+                return (pi.set_glitch_filter(p1, p2), b'')
+            if cmd == 99:
+                handle = 0
+                while handle in self.handles:
+                    handle += 1
+                self.handles[handle] = [writer, 0]
+                return (handle, b'')
+        except pigpio.error:
+            if cmd in (38, 39, 40, 41, 45):
+                return (pigpio.PI_BAD_SCRIPT_ID, b'')
+            return (pigpio.PI_NOT_PWM_GPIO, b'')
+
+        logging.warning(f'Unsupported command {cmd}')
+        return (pigpio.PI_UNKNOWN_COMMAND, b'')
+
+
+    def level(self, gpio, level):
+        """
+        Set a pin level and report it to the notification sockets.
+        """
+
+        if level:
+            self.levels |= 1 << gpio
+        else:
+            self.levels &= ~(1 << gpio)
+
+        report = struct.pack('HHII', 0, 0, self.tick(), self.levels)
+        for (writer, bits) in self.handles.values():
+            if bits & (1 << gpio):
+                writer.write(report)
+
+
+async def serve(daemon, host, port):
+    """
+    Run the daemon on host and port until cancelled.
+    """
+
+    server = await asyncio.start_server(daemon.client, host, port)
+    logging.info(f'Fake pigpiod listening on {host}:{port}')
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Fake pigpio daemon for load testing')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--latency', type=float, default=0, help='seconds added to every command')
+    parser.add_argument('--jitter', type=float, default=0, help='up to this many more seconds, at random')
+    parser.add_argument('--quiet', action='store_true', help='do not log every command')
+    args = parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.WARNING if args.quiet else logging.INFO,
+                        format='[%(levelname)s]  %(asctime)s - %(message)s',
+                        )
+
+    daemon = fake_pigpiod(args.latency, args.jitter)
+    try:
+        asyncio.run(serve(daemon, args.host, args.port))
+    except KeyboardInterrupt:
+        logging.info(f'Served {daemon.commands} commands')
+
+
+if __name__ == "__main__":
+    main(sys.argv)
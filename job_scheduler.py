@@ -0,0 +1,371 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# job_scheduler.py
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+One APScheduler per host, however many API workers there are.
+
+Every worker makes a job_scheduler, and they hold an election with
+an exclusive lock on a file. The winner, the leader, runs the real
+scheduler and serves the others on a Unix socket next to the lock.
+The rest only submit and query jobs, through that socket.
+
+The others each keep a thread blocked waiting for the lock. When the
+leader dies the kernel frees its lock and one of them takes over
+straight away, loading the jobs from the jobstore.
+
+Jobs cross the socket as plain data: the function as a textual
+reference ('module:function'), trigger arguments as strings and
+numbers, and datetimes as ISO 8601 strings. Jobs come back as dicts
+made by describe_job().
+
+The leader measures how late each run of each job is: from the time
+it was scheduled for to the time.time() the job returns, if it
+returns one (light_jobs.run does, the time it dispatched at), or else
+to when it finished.
+
+The leader can also pre-roll jobs: it calls a preroll hook for each
+job preroll_time seconds before it is due, once per fire time, so the
+job can be got ready to start exactly on time (light_jobs.preroll arms
+scenes this way). If the job is removed or changed before then, a
+cancel_preroll hook undoes it. A job that returns not_measured, as a
+pre-rolled one does, is left out of the latency stats: it was got
+going ahead of its trigger, not by it.
+"""
+
+import os
+import time
+import fcntl
+import logging
+import threading
+
+from datetime import datetime, timedelta, timezone
+
+from apscheduler.util import obj_to_ref, astimezone
+from apscheduler.events import EVENT_JOB_EXECUTED, EVENT_JOB_ADDED, EVENT_JOB_MODIFIED, EVENT_JOB_REMOVED
+from apscheduler.jobstores.base import JobLookupError, ConflictingIdError
+
+import led_daemon
+from solar import solar_trigger
+
+
+# Returned by a job that should not count towards its latency stats
+not_measured = 'not measured'
+
+
+def describe_job(job, latency = None):
+    """
+    Return a JSON friendly dict describing an APScheduler job, with
+    its latency stats if given.
+    """
+
+    trigger = {}
+    for f in getattr(job.trigger, 'fields', []):
+        trigger[f.name] = str(f)
+
+    return {
+        'id': job.id,
+        'name': job.name,
+        'next_run': job.next_run_time.isoformat() if job.next_run_time else None,
+        'trigger': trigger or str(job.trigger),
+        'latency_ms': latency,
+    }
+
+
+class job_scheduler:
+    """
+    The scheduler of this host, wherever it is running.
+    """
+
+    def __init__(self, factory, lock_path = 'scheduler.lock', socket_path = 'scheduler.sock', failover = 10,
+                 preroll = None, cancel_preroll = None, preroll_time = 5):
+        """
+        factory is called with no arguments, in the leader only, to
+        make the APScheduler scheduler. It must not start it.
+
+        Calls made while there is no leader wait up to failover
+        seconds for one.
+
+        preroll, if given, is called in the leader as preroll(job, when)
+        preroll_time seconds before each time a job is due. If the job
+        is then removed or changed before when, cancel_preroll is called
+        the same way, with the job as it was pre-rolled.
+        """
+
+        self.factory = factory
+        self.preroll = preroll
+        self.cancel_preroll = cancel_preroll
+        self.preroll_time = preroll_time
+        self.lock_path = os.path.abspath(lock_path)
+        self.socket_path = os.path.abspath(socket_path)
+        self.failover = failover
+        self.client = led_daemon.socket_client(self.socket_path, timeout=failover)
+        self.reset()
+        os.register_at_fork(after_in_child=self.forked)
+
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.lock_file = None
+        self.scheduler = None
+        self.server = None
+        self.leading = threading.Event()
+        # job id -> {'count', 'last', 'mean', 'max'} in ms
+        self.latency = {}
+        # (job id, fire time) -> job, for the runs already pre-rolled
+        self.prerolled = {}
+        self.preroll_lock = threading.Lock()
+        self.jobs_changed = threading.Event()
+
+
+    def start(self):
+        """
+        Stand for leader. Win now if there is no leader, otherwise
+        wait in the background to take over.
+        """
+
+        self.lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            threading.Thread(target=self.campaign, daemon=True).start()
+            return
+        self.lead()
+
+
+    def campaign(self):
+        """
+        Wait for the leader to go, then lead. Run on its own thread.
+        """
+
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        self.lead()
+
+
+    def lead(self):
+        """
+        Start the real scheduler and serve the other workers.
+        """
+
+        logging.info(f'Process {os.getpid()} is the scheduler leader')
+        self.scheduler = self.factory()
+        self.scheduler.add_listener(self.executed, EVENT_JOB_EXECUTED)
+        self.scheduler.start()
+
+        self.server = led_daemon.listen(self.socket_path, {
+            'add_job': self.local_add_job,
+            'get_jobs': self.local_get_jobs,
+            'get_job': self.local_get_job,
+            'remove_job': self.local_remove_job,
+            'timeline': self.local_timeline,
+        })
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        if self.preroll is not None:
+            self.scheduler.add_listener(self.job_changed, EVENT_JOB_ADDED | EVENT_JOB_MODIFIED | EVENT_JOB_REMOVED)
+            threading.Thread(target=self.prerolling, daemon=True).start()
+        self.leading.set()
+
+
+    def prerolling(self):
+        """
+        Pre-roll thread of the leader. Calls preroll for every job due
+        within preroll_time seconds, then sleeps until the next one is,
+        or the jobs change.
+        """
+
+        lead = timedelta(seconds=self.preroll_time)
+        while True:
+            self.jobs_changed.clear()
+            now = datetime.now(timezone.utc)
+            wake = 60
+            for job in self.scheduler.get_jobs():
+                when = job.next_run_time
+                if when is None or when <= now:
+                    continue
+                if when - now > lead:
+                    wake = min(wake, (when - now - lead).total_seconds())
+                    continue
+
+                # Look again once it has fired, for its next run
+                wake = min(wake, (when - now).total_seconds() + 0.1)
+                with self.preroll_lock:
+                    if (job.id, when) in self.prerolled:
+                        continue
+                    self.prerolled[(job.id, when)] = job
+                    try:
+                        self.preroll(job, when)
+                    except Exception:
+                        logging.exception(f'Unable to pre-roll job {job.id}')
+
+            with self.preroll_lock:
+                for key in [key for key in self.prerolled if key[1] <= now]:
+                    del self.prerolled[key]
+            self.jobs_changed.wait(wake)
+
+
+    def job_changed(self, event):
+        """
+        Scheduler listener: a job was added, changed or removed.
+
+        Cancels a pre-roll of the job that is not yet due, then has the
+        pre-roll thread look at the jobs again, which pre-rolls it anew
+        if it is still due soon.
+        """
+
+        now = datetime.now(timezone.utc)
+        with self.preroll_lock:
+            for (job_id, when) in [key for key in self.prerolled if key[0] == event.job_id and key[1] > now]:
+                job = self.prerolled.pop((job_id, when))
+                if self.cancel_preroll is not None:
+                    try:
+                        self.cancel_preroll(job, when)
+                    except Exception:
+                        logging.exception(f'Unable to cancel the pre-roll of job {job_id}')
+        self.jobs_changed.set()
+
+
+    def forked(self):
+        """
+        Start again in a forked child, which inherits a copy of the
+        lock but none of the threads, so must not lead.
+        """
+
+        started = self.lock_file is not None
+        if started:
+            self.lock_file.close()
+        self.reset()
+        if started:
+            self.start()
+
+
+    def executed(self, event):
+        """
+        Scheduler listener: record how late a job run was.
+        """
+
+        if event.retval == not_measured:
+            return
+        done = event.retval if isinstance(event.retval, float) else time.time()
+        late = (done - event.scheduled_run_time.timestamp()) * 1000
+        stats = self.latency.setdefault(event.job_id, {'count': 0, 'last': 0, 'mean': 0, 'max': 0})
+        stats['count'] += 1
+        stats['last'] = late
+        stats['mean'] += (late - stats['mean']) / stats['count']
+        # Pre-rolled jobs are dispatched early, so late can be negative
+        stats['max'] = late if stats['count'] == 1 else max(stats['max'], late)
+        logging.info(f'Job {event.job_id} ran {late:.1f} ms after its trigger')
+
+
+    def is_leader(self):
+        return self.leading.is_set()
+
+
+    def call(self, command, *args):
+        """
+        Run a command on the leader, here or over its socket.
+
+        Raises ValueError for an invalid job.
+        """
+
+        end = time.monotonic() + self.failover
+        while True:
+            if self.leading.is_set():
+                return getattr(self, 'local_' + command)(*args)
+            try:
+                return self.client.call(command, *args)
+            except OSError:
+                # No leader, or it just died. Wait for the next one.
+                if time.monotonic() > end:
+                    raise
+                self.leading.wait(0.05)
+
+
+    # ============================================================
+    # What workers call
+
+    def add_job(self, func, trigger = None, **kwargs):
+        """
+        Add a job, taking the same arguments as APScheduler's add_job.
+
+        func may be a function or a textual reference to one. As well
+        as APScheduler's triggers there is 'solar', which takes event,
+        latitude, longitude, offset and timezone (see solar_trigger).
+        """
+
+        if callable(func):
+            func = obj_to_ref(func)
+        return self.call('add_job', func, trigger, kwargs)
+
+
+    def get_jobs(self):
+        return self.call('get_jobs')
+
+
+    def get_job(self, job_id):
+        """
+        Return the job with this id, or None.
+        """
+
+        return self.call('get_job', job_id)
+
+
+    def remove_job(self, job_id):
+        return self.call('remove_job', job_id)
+
+
+    def timeline(self, job_id, count = 10):
+        """
+        Return the next count fire times of a job, as ISO 8601 strings.
+        """
+
+        return self.call('timeline', job_id, count)
+
+
+    # ============================================================
+    # What the leader runs
+
+    def local_add_job(self, func, trigger, kwargs):
+        try:
+            if trigger == 'solar':
+                trigger = solar_trigger(kwargs.pop('event'), kwargs.pop('latitude'), kwargs.pop('longitude'),
+                                        kwargs.pop('offset', 0), astimezone(kwargs.pop('timezone', None)) or self.scheduler.timezone)
+            job = self.scheduler.add_job(func, trigger, **kwargs)
+            self.latency.pop(job.id, None)
+            return describe_job(job)
+        except (ValueError, TypeError, LookupError, ConflictingIdError) as e:
+            raise ValueError([str(e)])
+
+
+    def local_get_jobs(self):
+        return [describe_job(job, self.latency.get(job.id)) for job in self.scheduler.get_jobs()]
+
+
+    def local_get_job(self, job_id):
+        job = self.scheduler.get_job(job_id)
+        return describe_job(job, self.latency.get(job.id)) if job else None
+
+
+    def local_remove_job(self, job_id):
+        try:
+            self.scheduler.remove_job(job_id)
+            self.latency.pop(job_id, None)
+        except JobLookupError as e:
+            raise ValueError([str(e)])
+
+
+    def local_timeline(self, job_id, count):
+        job = self.scheduler.get_job(job_id)
+        if job is None:
+            raise ValueError([f'no job {job_id!r}'])
+
+        times = []
+        when = job.next_run_time
+        while when is not None and len(times) < count:
+            times.append(when.isoformat())
+            when = job.trigger.get_next_fire_time(when, when + timedelta(microseconds=1))
+        return times
@@ -0,0 +1,241 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# jobstore.py
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+An APScheduler jobstore kept in memory and written behind to SQLite.
+
+SQLAlchemyJobStore reads the database every time the scheduler wakes
+up and every time anyone lists the jobs, which on a Pi means the SD
+card. cached_jobstore loads every job once, at start, and from then on
+answers from memory: the jobs are kept in next run time order, as
+MemoryJobStore keeps them, so finding the due jobs never searches.
+
+Changes are queued and written by a background thread, one
+transaction for everything that changed in the last delay seconds.
+A job changed twice in that time is written once. The database is in
+WAL mode with full sync, so every committed batch survives a power
+cut, and at worst the last delay seconds of changes are lost: a job
+added just before the cut, or a next run time, which the scheduler
+then treats as a misfire.
+
+The table is the one SQLAlchemyJobStore uses, so jobs.sqlite files
+made by it load as they are.
+"""
+
+import time
+import pickle
+import atexit
+import logging
+import sqlite3
+import threading
+
+from apscheduler.job import Job
+from apscheduler.jobstores.memory import MemoryJobStore
+
+
+class cached_jobstore(MemoryJobStore):
+    """
+    Jobs in memory, persisted to a SQLite file in the background.
+    """
+
+    def __init__(self, path = 'jobs.sqlite', table = 'apscheduler_jobs', delay = 0.5,
+                 pickle_protocol = pickle.HIGHEST_PROTOCOL):
+        """
+        Changes are written at most delay seconds after they are made.
+        """
+
+        super().__init__()
+        self.path = path
+        self.table = table
+        self.delay = delay
+        self.pickle_protocol = pickle_protocol
+
+        # job id -> (next run timestamp, pickled state), or None to delete
+        self.pending = {}
+        self.lock = threading.Condition()
+        # Held while writing, so batches are written in order
+        self.writing = threading.Lock()
+        self.thread = None
+        self.running = False
+        self.batches = 0
+
+
+    def connect(self):
+        """
+        Open the database, creating the table if needed.
+        """
+
+        db = sqlite3.connect(self.path)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=FULL')
+        db.execute(f'CREATE TABLE IF NOT EXISTS {self.table} ('
+                   'id VARCHAR(191) NOT NULL PRIMARY KEY, '
+                   'next_run_time FLOAT, '
+                   'job_state BLOB NOT NULL)')
+        db.execute(f'CREATE INDEX IF NOT EXISTS ix_{self.table}_next_run_time ON {self.table} (next_run_time)')
+        return db
+
+
+    def start(self, scheduler, alias):
+        """
+        Load every job from the database and start the writer thread.
+        """
+
+        super().start(scheduler, alias)
+
+        db = self.connect()
+        try:
+            rows = db.execute(f'SELECT id, job_state FROM {self.table}').fetchall()
+        finally:
+            db.close()
+
+        broken = []
+        for (job_id, state) in rows:
+            try:
+                MemoryJobStore.add_job(self, self.reconstitute(state))
+            except Exception:
+                logging.exception(f'Unable to restore job {job_id}, removing it')
+                broken.append(job_id)
+        logging.info(f'Loaded {len(rows) - len(broken)} jobs from {self.path}')
+
+        with self.lock:
+            for job_id in broken:
+                self.pending[job_id] = None
+            self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+
+    def reconstitute(self, state):
+        """
+        Return the Job pickled in state.
+        """
+
+        state = pickle.loads(state)
+        state['jobstore'] = self
+        job = Job.__new__(Job)
+        job.__setstate__(state)
+        job._scheduler = self._scheduler
+        job._jobstore_alias = self._alias
+        return job
+
+
+    def shutdown(self):
+        """
+        Write everything still pending, then stop.
+        """
+
+        with self.lock:
+            self.running = False
+            self.lock.notify()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+        # Not remove_all_jobs(), that would queue deleting them all
+        self._jobs = []
+        self._jobs_index = {}
+
+
+    # ============================================================
+    # Changes, made in memory then queued
+
+    def add_job(self, job):
+        super().add_job(job)
+        self.changed(job)
+
+
+    def update_job(self, job):
+        super().update_job(job)
+        self.changed(job)
+
+
+    def remove_job(self, job_id):
+        super().remove_job(job_id)
+        self.queue(job_id, None)
+
+
+    def remove_all_jobs(self):
+        ids = list(self._jobs_index)
+        super().remove_all_jobs()
+        for job_id in ids:
+            self.queue(job_id, None)
+
+
+    def changed(self, job):
+        """
+        Queue the job as it is now to be written.
+        """
+
+        (job, timestamp) = self._jobs_index[job.id]
+        self.queue(job.id, (timestamp, pickle.dumps(job.__getstate__(), self.pickle_protocol)))
+
+
+    def queue(self, job_id, row):
+        with self.lock:
+            self.pending[job_id] = row
+            self.lock.notify()
+
+
+    # ============================================================
+    # Writing
+
+    def run(self):
+        """
+        Writer thread. Waits for changes, gives more delay seconds to
+        arrive, then writes them all in one transaction.
+        """
+
+        while True:
+            with self.lock:
+                while self.running and not self.pending:
+                    self.lock.wait()
+                if not self.running:
+                    return
+            time.sleep(self.delay)
+            self.flush()
+
+
+    def flush(self):
+        """
+        Write every pending change now, in one transaction.
+        """
+
+        with self.writing:
+            with self.lock:
+                (pending, self.pending) = (self.pending, {})
+            if pending:
+                self.write(pending)
+
+
+    def write(self, pending):
+        """
+        Write some changes in one transaction. Call with writing held.
+
+        If that fails they are queued again, unless changed since.
+        """
+
+        try:
+            db = self.connect()
+            try:
+                with db:
+                    for (job_id, row) in pending.items():
+                        if row is None:
+                            db.execute(f'DELETE FROM {self.table} WHERE id = ?', (job_id,))
+                        else:
+                            db.execute(f'INSERT OR REPLACE INTO {self.table} (id, next_run_time, job_state) VALUES (?, ?, ?)',
+                                       (job_id, row[0], row[1]))
+            finally:
+                db.close()
+            self.batches += 1
+        except sqlite3.Error:
+            logging.exception(f'Unable to write {len(pending)} job changes to {self.path}, will retry')
+            with self.lock:
+                for (job_id, row) in pending.items():
+                    self.pending.setdefault(job_id, row)
@@ -0,0 +1,377 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# led_daemon.py
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+The one process that owns the LED strips.
+
+Under uWSGI each API worker is its own process. If each drove the
+strips they would all run their own fades on the same pins. Instead
+this daemon imports lights, and so owns every strip, action and
+renderer, and the workers send it commands over a Unix socket:
+
+    python led_daemon.py --socket /tmp/led_daemon.sock
+
+Run api_server with LED_DAEMON=/tmp/led_daemon.sock to use it.
+
+Each message is a 4 byte big endian length and a msgpack array. A
+request is [command, args...], the reply [status, result] where status
+is OK, or INVALID with a list of errors. The commands are:
+
+    execute operations      -> {name: [red, green, blue]}
+    check operations        -> list of errors, empty if valid
+    state version           -> [version, snapshot or None if unchanged]
+                               (versions are strings, boot id and counter)
+    wait version timeout    -> True if the state moved past version
+    describe                -> devices and groups, see lights.describe
+    metrics                 -> renderer stats, see lights.metrics
+
+The server and client here are not tied to these commands; the
+scheduler leader (job_scheduler) serves its own over them.
+"""
+
+import os
+import sys
+import json
+import struct
+import socket
+import logging
+import argparse
+import threading
+import socketserver
+import msgpack
+
+from datetime import datetime
+
+
+default_socket = '/tmp/led_daemon.sock'
+
+# Reply status
+OK = 0
+INVALID = 1
+
+# Largest message either end will read
+max_message = 1 << 20
+
+header = struct.Struct('!I')
+
+
+def send(sock, message):
+    """
+    Send one framed message.
+    """
+
+    data = msgpack.packb(message, default=encode)
+    sock.sendall(header.pack(len(data)) + data)
+
+
+def encode(value):
+    """
+    msgpack hook for values it does not know. Datetimes are sent as
+    ISO 8601 strings, which APScheduler takes anywhere it takes a
+    datetime.
+    """
+
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'can not send {type(value).__name__}')
+
+
+def receive(stream):
+    """
+    Read one framed message from a file-like stream, None at end.
+    """
+
+    head = stream.read(header.size)
+    if len(head) < header.size:
+        return None
+    (length,) = header.unpack(head)
+    if length > max_message:
+        raise ValueError(f'message of {length} bytes is too long')
+    data = stream.read(length)
+    if len(data) < length:
+        return None
+    return msgpack.unpackb(data)
+
+
+# ============================================================
+# Daemon
+
+class handler(socketserver.StreamRequestHandler):
+    """
+    Serve the commands from one client connection until it closes.
+    """
+
+    def handle(self):
+        commands = self.server.commands
+        while True:
+            try:
+                request = receive(self.rfile)
+            except ValueError as e:
+                logging.warning(f'Dropping client: {e}')
+                return
+            if request is None:
+                return
+
+            (command, args) = (request[0], request[1:])
+            try:
+                if command in commands:
+                    reply = [OK, commands[command](*args)]
+                else:
+                    reply = [INVALID, [f'unknown command {command!r}']]
+            except ValueError as e:
+                reply = [INVALID, e.args[0] if e.args and isinstance(e.args[0], list) else [str(e)]]
+            except Exception as e:
+                logging.exception(f'Command {command} failed')
+                reply = [INVALID, [f'{command} failed: {e}']]
+            send(self.connection, reply)
+
+
+class server(socketserver.ThreadingUnixStreamServer):
+    """
+    One handler thread per client connection. commands maps each
+    command name to the function that runs it.
+    """
+
+    daemon_threads = True
+    commands = {}
+
+
+def listen(path, commands):
+    """
+    Return a server for commands on the Unix socket at path.
+
+    Call serve_forever() on it to start serving.
+    """
+
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = server(path, handler)
+    listener.commands = commands
+    # The API workers run as another user in the same group
+    os.chmod(path, 0o660)
+    return listener
+
+
+def serve(path = default_socket):
+    """
+    Set up the strips and serve commands on the Unix socket at path.
+    """
+
+    # Only the daemon imports lights, clients must not own the strips
+    import lights
+
+    def state(version):
+        (current, snapshot, body) = lights.states.get()
+        return [current, None if current == version else snapshot]
+
+    daemon = listen(path, {
+        'execute': lights.execute,
+        'check': lights.check,
+        'state': state,
+        'wait': lights.states.wait,
+        'describe': lights.describe,
+        'metrics': lights.metrics,
+    })
+
+    lights.setup()
+    logging.info(f'LED daemon listening on {path}')
+    try:
+        daemon.serve_forever()
+    finally:
+        daemon.server_close()
+        os.unlink(path)
+
+
+# ============================================================
+# Client
+
+class socket_client:
+    """
+    Send commands to a server made by listen().
+
+    Each thread gets its own connection, made on first use and made
+    again after a fork or if the server restarts.
+    """
+
+    def __init__(self, path, timeout = 120):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+
+
+    def connection(self):
+        """
+        Return this thread's socket to the server.
+        """
+
+        local = self.local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.sock = None
+            local.pid = os.getpid()
+        if local.sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            local.sock = sock
+            local.stream = sock.makefile('rb')
+        return local
+
+
+    def close(self):
+        """
+        Close this thread's socket.
+        """
+
+        local = self.local
+        if getattr(local, 'sock', None) is not None and local.pid == os.getpid():
+            local.stream.close()
+            local.sock.close()
+        local.sock = None
+
+
+    def call(self, *request):
+        """
+        Send a request and return the result.
+
+        Tries once more on a new connection if the first one fails.
+        Raises ValueError with the server's errors for an invalid request.
+        """
+
+        for attempt in (1, 2):
+            try:
+                local = self.connection()
+                send(local.sock, list(request))
+                reply = receive(local.stream)
+                if reply is None:
+                    raise ConnectionError(f'{self.path} closed the connection')
+                break
+            except OSError:
+                self.close()
+                if attempt == 2:
+                    raise
+
+        (status, result) = reply
+        if status != OK:
+            raise ValueError(result)
+        return result
+
+
+class client(socket_client):
+    """
+    Talk to the daemon. Has the same execute(), check(), describe(), metrics() and states
+    as the lights module, so api_server can use either.
+    """
+
+    def __init__(self, path = default_socket, timeout = 120):
+        socket_client.__init__(self, path, timeout)
+        self.states = remote_states(self)
+
+
+    def setup(self):
+        """
+        Nothing to do, the daemon sets up its own strips.
+        """
+
+
+    def execute(self, operations):
+        return {led: tuple(color) for (led, color) in self.call('execute', operations).items()}
+
+
+    def check(self, operations):
+        return self.call('check', operations)
+
+
+    def describe(self):
+        return self.call('describe')
+
+
+    def metrics(self):
+        return self.call('metrics')
+
+
+class remote_states:
+    """
+    The daemon's state_cache, as seen from a client.
+
+    The last snapshot is kept, and only fetched again when the
+    daemon's version has moved on. Versions carry the daemon's boot
+    id (see state_cache), so a restarted daemon never matches the
+    snapshot kept from before.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.Lock()
+        self.version = None
+        self.snapshot = {}
+        self.body = b'{}'
+
+
+    def get(self):
+        """
+        Return (version, snapshot dict, JSON body bytes).
+        """
+
+        (version, snapshot) = self.client.call('state', self.version)
+        with self.lock:
+            if snapshot is not None and version != self.version:
+                self.snapshot = {led: tuple(color) for (led, color) in snapshot.items()}
+                self.body = json.dumps(self.snapshot).encode()
+                self.version = version
+            return (self.version, self.snapshot, self.body)
+
+
+    def etag(self, version = None):
+        return self.version if version is None else version
+
+
+    def wait(self, version, timeout):
+        return self.client.call('wait', version, timeout)
+
+
+# What connect() returned, made on first call
+connected = None
+
+
+def connect(path = None):
+    """
+    Return what this process sends light commands to.
+
+    That is a client of the daemon at path, or at LED_DAEMON, if
+    either is set. Otherwise it is the lights module, and this process
+    owns the strips itself.
+    """
+
+    global connected
+    if connected is None:
+        path = path or os.getenv('LED_DAEMON')
+        if path:
+            connected = client(path)
+        else:
+            import lights
+            connected = lights
+    return connected
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Own the LED strips and serve commands to the API workers')
+    parser.add_argument('--socket', default=os.getenv('LED_DAEMON', default_socket), help='Unix socket to listen on')
+    args = parser.parse_args(argv[1:])
+
+    logging.basicConfig(level=logging.INFO,
+                        format='[%(levelname)s]  %(asctime)s - %(message)s',
+                        )
+
+    try:
+        serve(args.socket)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -10,34 +10,134 @@
 # Improvements that may never get done
 # (come on this is a personal home project ):
 #
-# - Create a list of "actions"
-#   This should allow for a better method to expand the 
-#   differnt lighting schemes as they become needed/wanted.
-#   This will include 
-#   - Move sunrise into the actions
-#   - Move fade into the actions
-#   - Combine stop_sunrise and stop_fade to become stop_actions
-#
-# - Add an active() method
-#   This returns the action name if any actions are currently running,
-#   false if none are running.
-#
 # - Huntdown all hardcoded assumption and make then configurable
 #   Know assumptions are:
 #    - PWM limits of 0 as on  and 255 as off
 #    - pigpio daemon is on local server
 #
 # - Allow global fade_duration to be set by the user
-#
-# - Allow rempte PI to be used in pigpio init
 
 """Control an RGB LED strip on a Raspberry Pi"""
 
+import os
 import time
 import math
+import queue
+import bisect
 import logging
+import threading
 import pigpio
-from multiprocessing import Process
+import pigpio_pool
+from multiprocessing.sharedctypes import RawArray
+
+import scenes
+from renderer import table_track
+from pigpio_script import compile_transition
+
+
+class action_engine(threading.Thread):
+    """
+    A long lived worker thread that runs the actions for one led strip.
+
+    An action is a generator. Each time it is advanced it does one
+    step of work (usually a direct_set) and yields the number of seconds
+    to wait before the next step. The engine waits on its command queue
+    instead of sleeping, so starting, replacing or stopping an action
+    is just a queue put rather than a process fork and kill.
+    """
+
+    def __init__(self):
+        """
+        Create the engine. It is a daemon thread so it never holds
+        the interpreter open on exit.
+        """
+
+        threading.Thread.__init__(self, daemon=True)
+        self.commands = queue.Queue()
+        self.action = None
+        self.action_name = None
+
+
+    def submit(self, command, name=None, action=None, wait=False):
+        """
+        Queue a command for the worker.
+
+        Commands are 'start', 'stop' and 'quit'. If wait is True this
+        blocks until the worker has acted on the command.
+        """
+
+        done = threading.Event() if wait else None
+        self.commands.put((command, name, action, done))
+        if done is not None:
+            done.wait()
+
+
+    def run(self):
+        """
+        Worker loop. Do not call directly, use start().
+        """
+
+        # When the current action's next step is due, None if idle.
+        # Commands that leave the action alone do not change it, so
+        # they never make a step come early.
+        due = None
+        while True:
+            delay = None if due is None else max(0, due - time.monotonic())
+            try:
+                (command, name, action, done) = self.commands.get(timeout=delay)
+            except queue.Empty:
+                command = None
+
+            if command == 'start':
+                self._close()
+                self.action = action
+                self.action_name = name
+                # Run the new action right away
+                due = time.monotonic()
+            elif command == 'stop':
+                # A named stop only stops the matching action
+                if name is None or name == self.action_name:
+                    self._close()
+                    due = None
+            elif command == 'quit':
+                self._close()
+                if done is not None:
+                    done.set()
+                return
+
+            if command is not None:
+                if done is not None:
+                    done.set()
+                continue
+
+            if self.action is None:
+                due = None
+                continue
+
+            try:
+                delay = next(self.action)
+                due = None if delay is None else time.monotonic() + delay
+            except StopIteration:
+                logging.info(f'Action {self.action_name} finished')
+                self.action = None
+                self.action_name = None
+                due = None
+            except Exception:
+                logging.exception(f'Action {self.action_name} failed')
+                self.action = None
+                self.action_name = None
+                due = None
+
+
+    def _close(self):
+        """
+        Drop the current action, if any.
+        """
+
+        if self.action is not None:
+            self.action.close()
+        self.action = None
+        self.action_name = None
 
 
 class led_strip:
@@ -48,12 +148,20 @@ class led_strip:
     that are given on led strip object creation.
     """
        
-    def __init__(self, red, green, blue, pwm_range = 100, fade_duration = 1):
+    # Seconds between checks on a running pigpio script
+    script_poll = 0.1
+
+    def __init__(self, red, green, blue, pwm_range = 100, fade_duration = 1, fps = 30, use_scripts = False, host = None, port = None, pi = None):
         """
         Object initialzation. Arguements are 
         pins for red, green, blue PWM chanels,
         maximum pwm value to send,
-        length of time to fade between transitions in seconds.
+        length of time to fade between transitions in seconds,
+        frames per second for timed fades (0 uses the old one step
+        per sleep fade),
+        run fades and sunrise as pigpio daemon scripts,
+        pigpio daemon host and port (None for the pigpio defaults),
+        backend to use instead of one from connect() (see connect()).
         """
 
         # Capture the given control pins
@@ -63,9 +171,23 @@ class led_strip:
 
         # Set the pwm_range, and use it as a placeholder for color settings
         self.pwm_range = pwm_range
-        self.pwm_red = pwm_range
-        self.pwm_green = pwm_range
-        self.pwm_blue = pwm_range
+
+        # Current pwm values (red, green, blue) in shared memory.
+        # Actions write here as they set the pins, and get() reads
+        # from here, so reading state never goes to the pigpio daemon.
+        # Forked processes share the same segment.
+        self.state = RawArray('i', (pwm_range, pwm_range, pwm_range))
+
+        # Last value written to each pin (None if unknown) so
+        # direct_set only writes the channels that change, and
+        # counters of the writes issued and skipped.
+        self.written = [None, None, None]
+        self.writes = 0
+        self.writes_suppressed = 0
+
+        # Called with the strip whenever its state changes. Keep
+        # these quick, they run on the action and renderer threads.
+        self.listeners = []
 
         # Set defaults for previous state. 0 = full on"
         self.old_red = 0
@@ -74,55 +196,70 @@ class led_strip:
 
         # Capture given transition fade time in seconds
         self.fade_duration = fade_duration
+        self.fps = fps
 
-        # Set up lists to capture action processes
-        # TODO: Combine into common generic actions
-        self.proc_fade = []
-        self.proc_sunrise = []
-
-        # Initilize PiGPIO interface
-        self.pi = pigpio.pi()
-
-        # Set initial state to off (max pwm_range)
-        # TODO: Save state to disk on changes and 
-        # if state file exists, restore on start up
-        if self.pi.get_PWM_range(self.red_pin) != pwm_range:
-            self.pi.set_PWM_range(self.red_pin, pwm_range)
-
-        if self.pi.get_PWM_range(self.green_pin) != pwm_range:
-            self.pi.set_PWM_range(self.green_pin, pwm_range)
-
-        if self.pi.get_PWM_range(self.blue_pin) != pwm_range:
-            self.pi.set_PWM_range(self.blue_pin, pwm_range)
-
-        # Get current state. Set one if it does not exist.
-        # I know that this looks redundent ... basically it
-        # sets any color to full on if it can not read it's value
-        # from the pigpio daemon. This means that if the lights
-        # come on at boot there is an error using the pigpio
-        # This will become confusing with persistent state
-        #
-        # Update: Now they set themselved to off... 
-        try:
-            self.pwm_red = self.pi.get_PWM_dutycycle(self.red_pin)
-        except:
-            self.pi.set_PWM_dutycycle(self.red_pin, pwm_range)
-            self.pwm_red = self.pi.get_PWM_dutycycle(self.red_pin)
+        # Hand transitions to pigpiod as scripts when possible
+        self.use_scripts = use_scripts
 
-        try:
-            self.pwm_green = self.pi.get_PWM_dutycycle(self.green_pin)
-        except:
-            self.pi.set_PWM_dutycycle(self.green_pin, pwm_range)
-            self.pwm_green = self.pi.get_PWM_dutycycle(self.green_pin)
+        # The action engine is started on first use. This keeps the
+        # worker thread out of any process that forks after creating
+        # the strip (uWSGI does this).
+        self.engine = None
+        self.engine_lock = threading.Lock()
 
-        try:
-            self.pwm_blue = self.pi.get_PWM_dutycycle(self.blue_pin)
-        except:
-            self.pi.set_PWM_dutycycle(self.blue_pin, pwm_range)
-            self.pwm_blue = self.pi.get_PWM_dutycycle(self.blue_pin)
+        # Color the last fade was started towards
+        self.fade_target = None
+
+        # Set by renderer.register() to run fades and scenes on a
+        # frame clock shared with other strips instead of the engine.
+        self.renderer = None
+
+        # Initilize PiGPIO interface. Connections are shared with
+        # the other strips and tools in this process.
+        if pi is None:
+            pi = connect(host, port)
+        self.pi = pi
+
+        # The pins are set up on first use, or for many strips at
+        # once with setup_strips(), so creating a strip never waits
+        # on the pigpio daemon.
+        self.ready = False
 
-        # Get and return the current state in a standard format
-        self.get()
+
+    def setup(self):
+        """
+        Set up the pins and read their state if not done yet.
+        """
+
+        if not self.ready:
+            setup_strips([self])
+
+
+    @property
+    def pwm_red(self):
+        return self.state[0]
+
+    @pwm_red.setter
+    def pwm_red(self, value):
+        self.state[0] = value
+
+
+    @property
+    def pwm_green(self):
+        return self.state[1]
+
+    @pwm_green.setter
+    def pwm_green(self, value):
+        self.state[1] = value
+
+
+    @property
+    def pwm_blue(self):
+        return self.state[2]
+
+    @pwm_blue.setter
+    def pwm_blue(self, value):
+        self.state[2] = value
 
 
     def direct_set(self, red, green, blue):
@@ -133,14 +270,55 @@ class led_strip:
         This is what the actions should call. 
         Do not call this from external code as it does not ensure
         that actions are stopped first.
+
+        Only channels that differ from the last value written to their
+        pin are sent to the pigpio daemon.
         """
-        
-        self.pi.set_PWM_dutycycle(self.red_pin, red)
-        self.pi.set_PWM_dutycycle(self.green_pin, green)
-        self.pi.set_PWM_dutycycle(self.blue_pin, blue)
-        self.pwm_red = red
-        self.pwm_green = green
-        self.pwm_blue = blue
+
+        if not self.ready:
+            self.setup()
+
+        color = (int(red), int(green), int(blue))
+        pins = (self.red_pin, self.green_pin, self.blue_pin)
+        for i in range(3):
+            if self.written[i] != color[i]:
+                self.pi.set_PWM_dutycycle(pins[i], color[i])
+                self.written[i] = color[i]
+                self.writes += 1
+            else:
+                self.writes_suppressed += 1
+        self.store(color)
+
+
+    def store(self, color):
+        """
+        Record color as the current state and tell the listeners if it changed.
+        """
+
+        color = tuple(color)
+        if tuple(self.state) != color:
+            self.state[:] = color
+            self.changed()
+
+
+    def changed(self):
+        """
+        Call every listener with this strip. Called on each state change.
+        """
+
+        for listener in self.listeners:
+            try:
+                listener(self)
+            except Exception:
+                logging.exception('State listener failed')
+
+
+    def write_stats(self):
+        """
+        Return the counts of pin writes issued and suppressed.
+        """
+
+        return {'writes': self.writes, 'suppressed': self.writes_suppressed}
 
 
     def set(self, red, green, blue, kill_procs = True):
@@ -153,45 +331,109 @@ class led_strip:
         """
 
         if kill_procs :
-            # TODO: Combine these into a generic actions
-            self.stop_fade()
-            self.stop_sunrise()
-
-        self.pwm_red = self.pi.get_PWM_dutycycle(self.red_pin)
-        self.pwm_green = self.pi.get_PWM_dutycycle(self.green_pin)
-        self.pwm_blue = self.pi.get_PWM_dutycycle(self.blue_pin)
+            self.stop_action('sunrise')
 
         return self.background_fade(red, green, blue)
 
 
+    def get_engine(self):
+        """
+        Return the running action engine for this strip.
+
+        The engine is (re)started here if it does not exist yet or
+        if it did not survive a fork.
+        """
+
+        with self.engine_lock:
+            if self.engine is None or not self.engine.is_alive():
+                self.engine = action_engine()
+                self.engine.start()
+            return self.engine
+
+
+    def background_action(self, name, action):
+        """
+        Run an action in the background, replacing any running action.
+
+        action is a generator as described in action_engine.
+        """
+
+        logging.info(f'Starting background action {name}')
+        if self.renderer is not None:
+            self.renderer.stop(self)
+        self.get_engine().submit('start', name, action, wait=True)
+
+
+    def background_track(self, name, track):
+        """
+        Run a renderer track in the background, replacing any running action.
+        """
+
+        logging.info(f'Starting background track {name}')
+        if self.engine is not None and self.engine.is_alive():
+            self.engine.submit('stop', wait=True)
+        self.renderer.play(self, name, track)
+
+
+    def rendered(self):
+        """
+        Return True if fades and scenes run on a shared renderer.
+
+        Script actions always run on the engine.
+        """
+
+        return self.renderer is not None and not self.use_scripts
+
+
+    def stop_action(self, name = None):
+        """
+        Stop the running action.
+
+        If a name is given only an action with that name is stopped.
+        This returns once the action has been stopped.
+        """
+
+        if self.renderer is not None:
+            self.renderer.stop(self, name)
+        if self.engine is not None and self.engine.is_alive():
+            self.engine.submit('stop', name, wait=True)
+
+
+    def active(self):
+        """
+        Return the name of the running action, or False if none.
+        """
+
+        if self.renderer is not None:
+            name = self.renderer.active(self)
+            if name:
+                return name
+        if self.engine is not None and self.engine.is_alive() and self.engine.action_name:
+            return self.engine.action_name
+        return False
+
+
     def background_fade(self, red, green, blue):
         """
         Run fade in the backgroud, allowing the main process to continue."
         
         Call this, do not call fade directly.
 
-        TODO: Combile this with background_sunrise() into
-            : a generic background_action() method and make this 
-            : a wrapper for that
-        """
-
-        logging.info('Starting background_fade')
-        if len(self.proc_fade) > 0:
-            logging.info('fade exists')
-            if not self.proc_fade[0].is_alive():
-                logging.info('fade is not alive')
-                for x in self.proc_fade:
-                    x.terminate()
-                    x.join()
-                self.proc_fade.clear()
-                proc = Process(target=self.fade, args=(red, green, blue,))
-                self.proc_fade.append(proc)
-                self.proc_fade[0].start()
-        else:
-            logging.info('calling Process fade')
-            proc = Process(target=self.fade, args=(red, green, blue,))
-            self.proc_fade.append(proc)
-            self.proc_fade[0].start()
+        A new target replaces the one a running fade is heading for,
+        and the fade carries on from where it has got to. Asking for
+        the target it is already heading for changes nothing.
+        """
+
+        target = (int(red), int(green), int(blue))
+        if self.fade_target == target and self.active() == 'fade':
+            return
+        self.fade_target = target
+
+        if self.rendered():
+            if self.engine is not None and self.engine.is_alive():
+                self.engine.submit('stop', wait=True)
+            return self.renderer.fade(self, target, self.fade_duration)
+        return self.background_action('fade', self.fade_steps(*target))
 
 
     def stop_fade(self):
@@ -199,29 +441,160 @@ class led_strip:
         Stop any fade actions.
         """
 
-        if len(self.proc_fade) > 0:
-            self.proc_fade[0].terminate()
-            self.proc_fade[0].join()
-            self.proc_fade.clear()
+        self.stop_action('fade')
 
 
     def fade(self, red, green, blue):
         """
         Fade the device from the current state to the desired state.
 
-        This transitions from the current state to the desired state
-        by changing each color value in increments and pausing between
-        each change.
-
         This is a blocking process. It is HIGHLY recommended that you
         use background_fade instead, unless you really want to stop
         responding to the users for up to a the full fade_duration.
+        """
+
+        for delay in self.fade_steps(red, green, blue):
+            time.sleep(delay)
+        return self.get()
+
+
+    def fade_steps(self, red, green, blue):
+        """
+        Fade action: move from the current state to the desired state.
+
+        Uses script_fade_steps when use_scripts is set, otherwise
+        timed_fade_steps when fps is set, stepped_fade_steps if not.
+        """
+
+        if self.use_scripts:
+            return self.script_fade_steps(red, green, blue)
+        if self.fps:
+            return self.timed_fade_steps(red, green, blue)
+        return self.stepped_fade_steps(red, green, blue)
+
 
-        Note: Because this is normally run in the background on a child
-        process all updates of the pwm color values do not get propigated
-        to the parent process. They are lost until the parent decides to 
-        update them.
+    def script_fade_steps(self, red, green, blue):
         """
+        Fade action: run the fade as a pigpio daemon script.
+        """
+
+        start = self.get()
+        keyframes = [(0, *start), (self.fade_duration, int(red), int(green), int(blue))]
+        if self.fps:
+            fallback = self.timed_fade_steps(red, green, blue)
+        else:
+            fallback = self.stepped_fade_steps(red, green, blue)
+        yield from self.script_steps(keyframes, fallback)
+
+
+    def script_steps(self, keyframes, fallback):
+        """
+        Action: run keyframes as a script inside the pigpio daemon.
+
+        The action only polls the script while it runs. Stopping the
+        action stops and deletes the script. If the script can not be
+        stored or started the fallback action is run instead.
+        """
+
+        # The script moves the pins without direct_set
+        self.written = [None, None, None]
+
+        pins = (self.red_pin, self.green_pin, self.blue_pin)
+        script = compile_transition(pins, keyframes, self.fps or 30)
+        sid = None
+        try:
+            sid = self.pi.store_script(script)
+            while self.pi.script_status(sid)[0] == pigpio.PI_SCRIPT_INITING:
+                time.sleep(0.001)
+            self.pi.run_script(sid)
+        except pigpio.error as e:
+            logging.warning(f'pigpio script failed ({e}), running in python')
+            if sid is not None:
+                self.delete_script(sid)
+            yield from fallback
+            return
+
+        # While the script runs, keep the shared state up to date
+        # from the keyframes rather than reading the pins back.
+        begin = time.monotonic()
+        segment = 0
+        try:
+            while True:
+                (status, params) = self.pi.script_status(sid)
+                if status == pigpio.PI_SCRIPT_FAILED:
+                    logging.warning(f'pigpio script {sid} failed')
+                if status not in (pigpio.PI_SCRIPT_RUNNING, pigpio.PI_SCRIPT_WAITING):
+                    break
+
+                t = time.monotonic() - begin
+                while segment < len(keyframes) - 2 and t > keyframes[segment + 1][0]:
+                    segment += 1
+                end = keyframes[min(segment + 1, len(keyframes) - 1)]
+                self.store(scenes.interpolate(keyframes[segment], end, t))
+
+                yield self.script_poll
+        finally:
+            self.delete_script(sid)
+            self.read_hardware()
+
+
+    def delete_script(self, sid):
+        """
+        Stop and remove a pigpio script, ignoring pigpio errors.
+        """
+
+        try:
+            self.pi.stop_script(sid)
+            self.pi.delete_script(sid)
+        except pigpio.error as e:
+            logging.warning(f'Unable to remove pigpio script {sid}: {e}')
+
+
+    def timed_fade_steps(self, red, green, blue):
+        """
+        Fade action: interpolate to the desired state over fade_duration.
+
+        The color for each frame is worked out from a monotonic clock,
+        so the fade always takes fade_duration no matter how far the
+        colors move. Frames where the color would not change are not
+        written, and the action sleeps straight through them.
+        """
+
+        start = self.get()
+        target = (int(red), int(green), int(blue))
+        logging.debug(f'Timed fade to: r:{red}  g:{green}  b:{blue}')
+
+        duration = self.fade_duration
+        frame = 1 / self.fps
+        begin = time.monotonic()
+        last = start
+        while True:
+            elapsed = time.monotonic() - begin
+            if elapsed >= duration:
+                break
+
+            t = elapsed / duration
+            color = tuple(round(s + (e - s) * t) for (s, e) in zip(start, target))
+            if color != last:
+                self.direct_set(*color)
+                last = color
+
+            # Wake on the next frame boundary
+            frames = math.floor(elapsed / frame) + 1
+            yield max(0, begin + frames * frame - time.monotonic())
+
+        self.direct_set(*target)
+
+
+    def stepped_fade_steps(self, red, green, blue):
+        """
+        Fade action: step from the current state to the desired state.
+
+        This transitions from the current state to the desired state
+        by changing each color value in increments and pausing between
+        each change.
+        """
+
         logging.debug(f'Fade to: r:{red}  g:{green}  b:{blue}')
         while int(red) != self.pwm_red or int(green) != self.pwm_green or int(blue) != self.pwm_blue:
             if int(red) > self.pwm_red :
@@ -247,29 +620,38 @@ class led_strip:
 
             self.direct_set(r, g, b)
 
-            time.sleep(self.fade_duration / self.pwm_range)
+            yield self.fade_duration / self.pwm_range
 
         # Paranoia: The device should already be in this state,
         # but I'm willing to burn a few cycles to ensure it is
         # just in case.
         self.direct_set(red, green, blue)
-        return self.get()
+
+
+    def read_hardware(self):
+        """
+        Refresh the stored state from the pigpio daemon.
+
+        Only the strip itself and its actions need this, when the pins
+        may have been changed behind its back. Use get() to read state.
+        """
+
+        self.store((
+            self.pi.get_PWM_dutycycle(self.red_pin),
+            self.pi.get_PWM_dutycycle(self.green_pin),
+            self.pi.get_PWM_dutycycle(self.blue_pin),
+        ))
+        self.written = list(self.state)
 
 
     def get(self):
         """
         Return the current pwm color values.
-
-        Due to the fact that the action child processes do not 
-        update the internl state values of their parents This
-        updates the stored state from reality prior to 
-        returning the stored state.
         """
 
-        self.pwm_red = self.pi.get_PWM_dutycycle(self.red_pin)
-        self.pwm_green = self.pi.get_PWM_dutycycle(self.green_pin)
-        self.pwm_blue = self.pi.get_PWM_dutycycle(self.blue_pin)
-        return (self.pwm_red, self.pwm_green, self.pwm_blue)
+        if not self.ready:
+            self.setup()
+        return tuple(self.state)
 
 
     def get_red(self):
@@ -277,8 +659,9 @@ class led_strip:
         Returns the pwm state of the red channel
         """
 
-        self.pwm_red = self.pi.get_PWM_dutycycle(self.red_pin)
-        return (self.pwm_red)
+        if not self.ready:
+            self.setup()
+        return self.state[0]
 
 
     def get_green(self):
@@ -286,8 +669,9 @@ class led_strip:
         Returns the pwm state of the green channel
         """
 
-        self.pwm_green = self.pi.get_PWM_dutycycle(self.green_pin)
-        return (self.pwm_green)
+        if not self.ready:
+            self.setup()
+        return self.state[1]
 
 
     def get_blue(self):
@@ -295,8 +679,9 @@ class led_strip:
         Returns the pwm state of the blue channel
         """
 
-        self.pwm_blue = self.pi.get_PWM_dutycycle(self.blue_pin)
-        return (self.pwm_blue)
+        if not self.ready:
+            self.setup()
+        return self.state[2]
 
 
     def off(self):
@@ -357,47 +742,65 @@ class led_strip:
         return self.set(self.pwm_range, self.pwm_range, 0)
 
 
+    def background_scene(self, name, duration=600, at=None):
+        """
+        Run a scene from the scenes module in the background.
+
+        If at is given, a time.time() timestamp, the scene is compiled
+        now and armed to start exactly then. On the renderer whatever
+        the strip is doing carries on until that moment.
+
+        The scene skips ahead to where it reaches the strip's current
+        brightness (see scenes.resume_time), rather than jumping to its
+        starting level.
+
+        The action is named after the scene.
+        Raises KeyError for an unknown scene.
+        """
+
+        if name not in scenes.SCENES:
+            raise KeyError(name)
+        if self.rendered():
+            table = scenes.compile_scene(name, duration, self.pwm_range, self.renderer.fps)
+            track = table_track(table, scenes.resume_time(table, self.get()))
+            if at is None:
+                return self.background_track(name, track)
+            logging.info(f'Arming background track {name} for {at - time.time():.2f} s from now')
+            return self.renderer.arm(self, name, track, time.monotonic() + at - time.time())
+        steps = self.scene_steps(name, duration)
+        if at is not None:
+            steps = self.delayed_steps(at, steps)
+        return self.background_action(name, steps)
+
+
+    def disarm_scene(self, name):
+        """
+        Cancel a scene armed by background_scene(at=...) that has not
+        started yet.
+        """
+
+        if self.rendered():
+            self.renderer.disarm(self, name)
+        else:
+            self.stop_action(name)
+
+
     def background_sunrise(self, duration=600):
         """
-        Run the sunrise action in a background process.
+        Run the sunrise action in the background.
 
         Call this, do not call sunrise directly.
+        """
 
-        TODO: Combile this with background_fade() into
-            : a generic background_action() method and make this 
-            : a wrapper for that
-        """
-
-        logging.info('Starting background_sunrise')
-        if len(self.proc_sunrise) > 0:
-            logging.info('sunrise exists')
-            if not self.proc_sunrise[0].is_alive():
-                logging.info('sunrise is not alive')
-                for x in self.proc_sunrise:
-                    x.terminate()
-                    x.join()
-                self.proc_sunrise.clear()
-                proc = Process(target=self.sunrise, args=(duration,))
-                self.proc_sunrise.append(proc)
-                self.proc_sunrise[0].start()
-        else:
-            logging.info('calling Process sunrise')
-            proc = Process(target=self.sunrise, args=(duration, ))
-            self.proc_sunrise.append(proc)
-            self.proc_sunrise[0].start()
+        return self.background_scene('sunrise', duration)
 
 
     def stop_sunrise(self):
         """
-        Stop all sunrise background processes.
-
-        TODO: Combine this with stop_fade() into stop_action()
+        Stop the sunrise action.
         """
 
-        if len(self.proc_sunrise) > 0:
-            self.proc_sunrise[0].terminate()
-            self.proc_sunrise[0].join()
-            self.proc_sunrise.clear()
+        self.stop_action('sunrise')
 
 
     def sunrise(self, duration = 600):
@@ -410,34 +813,172 @@ class led_strip:
         DO NOT CALL DIRECTLY use background_sunrise()
         """
 
-        logging.info('Starting sunrise')
-        self.sunrise = True
-        pwm_range = self.pwm_range
-        (red, green, blue) = self.get()
-        step_adjustment = 1.449
+        for delay in self.scene_steps('sunrise', duration):
+            time.sleep(delay)
+
+
+    def scene_steps(self, name, duration = 600):
+        """
+        Scene action. Runs as a pigpio script when use_scripts is set.
+        """
+
+        fps = self.fps or 30
+        table = scenes.compile_scene(name, duration, self.pwm_range, fps)
+        # Worked out when the action starts, not when it is submitted
+        start = scenes.resume_time(table, self.get())
+        if self.use_scripts and start < duration:
+            keyframes = scenes.trim(scenes.keyframes(name, duration, self.pwm_range), start)
+            yield from self.script_steps(keyframes, self.table_steps(table, start))
+        else:
+            yield from self.table_steps(table, start)
+
+
+    def delayed_steps(self, at, steps):
+        """
+        Action: wait until the time.time() at, then run the steps.
+        """
+
+        wait = at - time.time()
+        if wait > 0:
+            yield wait
+        yield from steps
+
+
+    def table_steps(self, table, start = 0):
+        """
+        Action: play a compiled scene_table from start seconds in.
+
+        Each sample is written at its time from the start of the action,
+        so the action takes exactly the table's duration, less start.
+        """
+
+        begin = time.monotonic() - start
+        first = max(0, bisect.bisect_right(table.times, start) - 1)
+        for i in range(first, len(table)):
+            wait = begin + table.times[i] - time.monotonic()
+            if wait > 0:
+                yield wait
+            self.direct_set(*table.color(i))
+
+
+# ============================================================
+# Backends
+#
+# A backend is whatever a strip uses as its pi. It must take these
+# pigpio.pi calls: get_PWM_range, set_PWM_range, get_PWM_dutycycle,
+# set_PWM_dutycycle, and for script mode store_script, run_script,
+# script_status, stop_script and delete_script. It may also have
+# batch() (see batch()).
+#
+# Backends by name:
+#   pigpio - pooled pigpio daemon connections (pigpio_pool)
+#   async  - pipelined asyncio client (async_pigpio.loop_pi)
+#   fake   - in-memory fake with recorded writes (fake_pigpio)
+
+# Used when a strip is not given a pi or a backend name
+default_backend = os.getenv('LED_BACKEND', 'pigpio')
+
+# Shared async and fake backends, by (backend, host, port)
+backends = {}
+backends_lock = threading.Lock()
+
+
+def connect(host = None, port = None, backend = None):
+    """
+    Return the backend strips on host and port should use.
+
+    backend is a name from the list above, default_backend if None.
+    Strips on the same host share the async and fake backends.
+    """
 
-        sleep = ((duration * step_adjustment) / (pwm_range * 3))
+    backend = backend or default_backend
+    if backend == 'pigpio':
+        return pigpio_pool.pi(host, port)
+
+    with backends_lock:
+        key = (backend, host, port)
+        if key not in backends:
+            if backend == 'async':
+                from async_pigpio import loop_pi
+                backends[key] = loop_pi(host, port)
+            elif backend == 'fake':
+                from fake_pigpio import fake_pi
+                backends[key] = fake_pi()
+            else:
+                raise ValueError(f'Unknown led backend {backend}')
+        return backends[key]
+
+
+def setup_strips(strips):
+    """
+    Set up the pins of many strips at once and read their state.
 
-        sleep = sleep / 5
-        logging.info("Sunrise - red dawn")
-        for red in range(red, 0, -1):
-            green = math.ceil(pwm_range - ((pwm_range - red) / 16))
-            blue = math.ceil(pwm_range - ((pwm_range - green) / 15))
-            self.direct_set(red, green, blue)
-            time.sleep(sleep)
+    Strips are grouped by pigpio connection and each group takes three
+    batches of commands however many strips it has: read the pwm ranges,
+    fix the ranges and read the duty cycles, then switch off any pin
+    that is not running pwm yet. Backends with a batch() call (like
+    async_pigpio.loop_pi) pipeline each batch in one round trip.
+    """
 
-        sleep = sleep * 5
-        logging.info("Sunrise - brighten")
-        for green in range(green, 0, -1):
-            blue = math.ceil(pwm_range - ((pwm_range - green) / 8))
-            self.direct_set(red, green, blue)
-            time.sleep(sleep)
+    with setup_lock:
+        groups = {}
+        for strip in strips:
+            if not strip.ready:
+                groups.setdefault(id(strip.pi), []).append(strip)
+
+        for group in groups.values():
+            pi = group[0].pi
+            pins = [(strip, i, pin) for strip in group
+                    for (i, pin) in enumerate((strip.red_pin, strip.green_pin, strip.blue_pin))]
+
+            ranges = batch(pi, [('get_PWM_range', (pin,)) for (strip, i, pin) in pins])
+
+            calls = []
+            for ((strip, i, pin), pwm_range) in zip(pins, ranges):
+                if pwm_range != strip.pwm_range:
+                    calls.append(('set_PWM_range', (pin, strip.pwm_range)))
+            duty_start = len(calls)
+            calls.extend(('get_PWM_dutycycle', (pin,)) for (strip, i, pin) in pins)
+            duties = batch(pi, calls)[duty_start:]
+
+            # A pin pigpio can not read is not running pwm yet.
+            # Set it to off (max pwm_range).
+            calls = []
+            for ((strip, i, pin), duty) in zip(pins, duties):
+                if isinstance(duty, Exception):
+                    calls.append(('set_PWM_dutycycle', (pin, strip.pwm_range)))
+                    duty = strip.pwm_range
+                strip.state[i] = duty
+            batch(pi, calls)
+
+            for strip in group:
+                # What was just read back is what the pins are set to
+                strip.written = list(strip.state)
+                strip.ready = True
+                strip.changed()
+
+
+def batch(pi, calls):
+    """
+    Run (method name, args) calls on pi and return their results.
 
-        for blue in range(blue, 0, -1):
-            self.direct_set(red, green, blue)
-            time.sleep(sleep)
+    A call that fails gives its exception as the result. Uses the
+    backend's batch() if it has one, one call at a time if not.
+    """
+
+    if not calls:
+        return []
+    if hasattr(pi, 'batch'):
+        return pi.batch(calls)
 
-        self.sunrise = False
-        logging.info("Sun's up!")
+    results = []
+    for (name, args) in calls:
+        try:
+            results.append(getattr(pi, name)(*args))
+        except pigpio.error as e:
+            results.append(e)
+    return results
 
 
+# Held while strips are set up
+setup_lock = threading.RLock()
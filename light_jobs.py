@@ -0,0 +1,170 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# light_jobs.py
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+Light actions for the scheduler to run.
+
+A scheduled light job is run(action, leds, params): the name of an
+action in the actions registry, the devices or groups it is for and
+its parameters, all plain data, so the job pickles into the jobstore
+and crosses the scheduler socket as is. run() turns it into lights
+operations and hands them straight to the strips (or led_daemon) with
+no Flask or HTTP in the way:
+
+    scheduler.add_job(light_jobs.run, 'cron', hour=6, minute=30,
+                      args=['sunrise', ['tim'], {'duration': 900}])
+
+run() returns the time it dispatched at, so job_scheduler measures
+how long after its trigger each job got the lights going.
+
+Scenes are pre-rolled: job_scheduler calls preroll() a few seconds
+before a scene job fires, which compiles the scene and arms it to
+start at the fire time exactly, and run() then has nothing left to
+do. If the job is removed or changed before then, unarm() cancels the
+armed scene. Changing or stopping the lights in between cancels it
+too, and run() leaves them as they were set. How close to the fire
+time the first frame came is the renderer's drift, in
+lights.metrics(). Pre-rolled runs are left out of the job's latency.
+"""
+
+import json
+import time
+import logging
+import threading
+
+import led_daemon
+from job_scheduler import not_measured
+
+
+def on(leds):
+    return [{'led': leds, 'action': 'on'}]
+
+
+def off(leds):
+    return [{'led': leds, 'action': 'off'}]
+
+
+def toggle(leds):
+    return [{'led': leds, 'action': 'toggle'}]
+
+
+def rgb(leds, red = None, green = None, blue = None):
+    return [{'led': leds, 'action': 'rgb', 'red': red, 'green': green, 'blue': blue}]
+
+
+def scene(leds, scene, duration = None):
+    op = {'led': leds, 'action': 'scene', 'scene': scene}
+    if duration is not None:
+        op['duration'] = duration
+    return [op]
+
+
+def sunrise(leds, duration = None):
+    return scene(leds, 'sunrise', duration)
+
+
+def sunset(leds, duration = None):
+    return scene(leds, 'sunset', duration)
+
+
+# Name -> function(leds, **params) returning lights operations
+actions = {
+    'on': on,
+    'off': off,
+    'toggle': toggle,
+    'rgb': rgb,
+    'scene': scene,
+    'sunrise': sunrise,
+    'sunset': sunset,
+}
+
+
+def operations(action, leds = 'all', params = None):
+    """
+    Return the lights operations for an action.
+
+    Raises ValueError for an unknown action or bad parameters.
+    """
+
+    if action not in actions:
+        raise ValueError([f'unknown action {action!r}'])
+    try:
+        return actions[action](leds, **(params or {}))
+    except TypeError as e:
+        raise ValueError([f'{action}: {e}'])
+
+
+# Jobs armed by preroll(): job_key() -> timestamp armed to start at
+armed = {}
+armed_lock = threading.Lock()
+
+
+def job_key(action, leds = 'all', params = None):
+    return (action, json.dumps(leds), json.dumps(params or {}, sort_keys=True))
+
+
+def preroll(job, when):
+    """
+    job_scheduler preroll hook: arm a scene job to start at when, the
+    aware datetime it is next due. Any other job runs when it fires.
+    """
+
+    if job.func_ref != f'{__name__}:run':
+        return
+    args = dict(zip(('action', 'leds', 'params'), job.args), **job.kwargs)
+    ops = operations(**args)
+    if not all(op['action'] == 'scene' for op in ops):
+        return
+
+    at = when.timestamp()
+    for op in ops:
+        op['at'] = at
+    led_daemon.connect().execute(ops)
+    with armed_lock:
+        armed[job_key(**args)] = at
+    logging.info(f'Scheduled {args["action"]} armed for {when.isoformat()}')
+
+
+def unarm(job, when):
+    """
+    job_scheduler cancel_preroll hook: cancel the scene preroll() armed
+    for a job removed or changed before it was due.
+    """
+
+    if job.func_ref != f'{__name__}:run':
+        return
+    args = dict(zip(('action', 'leds', 'params'), job.args), **job.kwargs)
+    with armed_lock:
+        if armed.pop(job_key(**args), None) is None:
+            return
+
+    ops = [dict(op, action='disarm') for op in operations(**args)]
+    led_daemon.connect().execute(ops)
+    logging.info(f'Scheduled {args["action"]} for {when.isoformat()} disarmed')
+
+
+def run(action, leds = 'all', params = None):
+    """
+    The scheduler job: run a light action now, unless preroll()
+    already armed it to start now.
+
+    Returns the time.time() the operations were handed over at, or
+    not_measured if they were armed.
+    """
+
+    with armed_lock:
+        at = armed.pop(job_key(action, leds, params), None)
+    if at is not None and abs(time.time() - at) < 60:
+        logging.info(f'Scheduled {action} on {leds} was armed')
+        return not_measured
+
+    ops = operations(action, leds, params)
+    led_daemon.connect().execute(ops)
+    dispatched = time.time()
+    logging.info(f'Scheduled {action} on {leds} dispatched')
+    return dispatched
@@ -0,0 +1,250 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# lights.py
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+The LED devices of this house and the operations run on them.
+
+Only one process should import this and drive the strips: led_daemon
+when the API runs with several workers, or api_server itself when it
+runs alone. Everything else asks that process, through execute(),
+check(), states, describe() and metrics(), which led_daemon.client
+copies over its socket.
+
+Operations are the dicts /batch takes:
+
+    {'led': 'tim', 'action': 'rgb', 'red': 0, 'green': 128}
+    {'led': ['tim', 'sharon'], 'action': 'scene', 'scene': 'sunset'}
+
+led is a device or group name, or a list of them. action is one of
+rgb, on, off, toggle, scene, disarm or fade_duration. A scene may have
+at, a time.time() timestamp to start it at rather than straight away;
+disarm cancels such a scene, by name, if it has not started.
+"""
+
+import scenes
+from led_strip import led_strip, setup_strips
+from renderer import renderer
+from state_cache import state_cache
+
+
+# ============================================================
+# LED Strip(s)
+
+# Set pwm range from 0 to 255
+# Zero if full on 255 is full off
+# TODO: Load these from a config file
+pwm_range = 255
+
+# Define the LED devices
+leds = {}
+
+# TODO: Load these from a config file
+leds['tim'] = led_strip(2, 3, 4, pwm_range)
+leds['sharon'] = led_strip(17, 27, 22, pwm_range)
+
+# Named groups of LED devices. Operations take a device name, a
+# group name or a list of either. 'all' is always every device.
+# TODO: Load these from a config file
+groups = {}
+groups['all'] = list(leds)
+
+# Run every strip from one frame clock so they fade in lockstep
+render = renderer(fps=30)
+for led in leds:
+    render.register(leds[led])
+
+# Every name an operation will take, resolved once to (name, strip) pairs
+targets = {}
+for led in leds:
+    targets[led] = ((led, leds[led]),)
+for group in groups:
+    targets.setdefault(group, tuple((led, leds[led]) for led in groups[group]))
+
+# Versioned snapshot of every strip's state
+states = state_cache(leds)
+
+# Target time range to go from current levels to full on
+# when running the sunrise process.
+# TODO: Load these from a config file
+time_to_full = 600
+
+# Longest scene or fade an operation may ask for, in seconds. Scenes
+# are compiled to a frame table, so this also bounds its size.
+max_duration = 24 * 60 * 60
+
+
+# ============================================================
+# Operations
+
+def setup():
+    """
+    Set up all the LED strips in one batch, if not done already.
+    """
+
+    setup_strips(leds.values())
+
+
+def describe():
+    """
+    Return the devices, with their pins and PWM range, and the groups.
+    """
+
+    ret = {'leds': {}, 'groups': groups}
+    for led in leds:
+        strip = leds[led]
+        ret['leds'][led] = {
+            'pins': [strip.red_pin, strip.green_pin, strip.blue_pin],
+            'pwm_range': strip.pwm_range,
+        }
+    return ret
+
+
+def execute(operations):
+    """
+    Check a list of operations, then apply them all on the same frame.
+
+    Returns {name: (red, green, blue)} for every device changed.
+    Raises ValueError with a list of errors, changing nothing, if
+    any operation is invalid.
+    """
+
+    errors = check(operations)
+    if errors:
+        raise ValueError(errors)
+
+    setup()
+    changed = {}
+    with render.batch():
+        for op in operations:
+            strips = resolve_targets(op['led'])
+            apply(strips, op)
+            changed.update(strips)
+    return {led: strip.get() for (led, strip) in changed.items()}
+
+
+def metrics():
+    """
+    Return the renderer's frame count, how late armed scenes started
+    (count, last, mean and max in ms), and each strip's pin writes
+    issued and suppressed as unchanged.
+    """
+
+    return {
+        'frames': render.frames,
+        'drift_ms': dict(render.drift),
+        'writes': {name: strip.write_stats() for (name, strip) in leds.items()},
+    }
+
+
+def resolve_targets(names):
+    """
+    Return the (name, strip) pairs for a device or group name, or a
+    list of them, in order without repeats.
+
+    Raises KeyError for an unknown name.
+    """
+
+    if isinstance(names, str):
+        names = names.split(',')
+    if len(names) == 1:
+        return targets[names[0]]
+
+    found = {}
+    for name in names:
+        for (led, strip) in targets[name]:
+            found[led] = strip
+    return tuple(found.items())
+
+
+def check(operations):
+    """
+    Return a list of what is wrong with some operations, empty if valid.
+    """
+
+    if not isinstance(operations, list):
+        return ['expected a list of operations']
+
+    errors = []
+    for (n, op) in enumerate(operations):
+        if not isinstance(op, dict):
+            errors.append(f'{n}: expected an object')
+            continue
+
+        action = op.get('action')
+        try:
+            strips = resolve_targets(op.get('led'))
+        except (KeyError, TypeError):
+            errors.append(f'{n}: unknown led {op.get("led")!r}')
+            continue
+        if not strips:
+            errors.append(f'{n}: no led given')
+            continue
+
+        if action == 'rgb':
+            pwm_range = min(strip.pwm_range for (led, strip) in strips)
+            for color in ('red', 'green', 'blue'):
+                value = op.get(color)
+                if value is not None and not (isinstance(value, int) and not isinstance(value, bool) and 0 <= value <= pwm_range):
+                    errors.append(f'{n}: {color} must be 0 to {pwm_range}')
+        elif action == 'disarm':
+            if op.get('scene') not in scenes.SCENES:
+                errors.append(f'{n}: unknown scene {op.get("scene")!r}')
+        elif action == 'scene':
+            if op.get('scene') not in scenes.SCENES:
+                errors.append(f'{n}: unknown scene {op.get("scene")!r}')
+            if not positive(op.get('duration', time_to_full)) or op.get('duration', time_to_full) > max_duration:
+                errors.append(f'{n}: duration must be a number of seconds from 0 to {max_duration}')
+            if op.get('at') is not None and not positive(op['at']):
+                errors.append(f'{n}: at must be a timestamp')
+        elif action == 'fade_duration':
+            if not positive(op.get('duration')) or op['duration'] > max_duration:
+                errors.append(f'{n}: duration must be a number of seconds from 0 to {max_duration}')
+        elif action not in ('on', 'off', 'toggle'):
+            errors.append(f'{n}: unknown action {action!r}')
+    return errors
+
+
+def positive(value):
+    """
+    Return True if value is a number greater than zero.
+    """
+
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0
+
+
+def apply(strips, op):
+    """
+    Apply one checked operation to some (name, strip) pairs.
+
+    toggle treats the strips as one: if they are all in the same
+    state they are toggled, otherwise they are all turned off.
+    """
+
+    action = op['action']
+    if action == 'toggle':
+        led_sum = [sum(strip.get()) for (led, strip) in strips]
+        if min(led_sum) != max(led_sum):
+            action = 'off'
+
+    for (led, strip) in strips:
+        if action == 'rgb':
+            # Colors not given keep heading where a running fade is
+            current = strip.fade_target if strip.active() == 'fade' and strip.fade_target else strip.get()
+            strip.set(*[c if op.get(color) is None else op[color] for (color, c) in zip(('red', 'green', 'blue'), current)])
+        elif action == 'on':
+            strip.on()
+        elif action == 'off':
+            strip.off()
+        elif action == 'toggle':
+            strip.toggle()
+        elif action == 'scene':
+            strip.background_scene(op['scene'], op.get('duration', time_to_full), op.get('at'))
+        elif action == 'disarm':
+            strip.disarm_scene(op['scene'])
+        elif action == 'fade_duration':
+            strip.fade_duration = op['duration']
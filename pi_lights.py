@@ -15,6 +15,7 @@ import time
 import logging
 import math
 import pigpio
+import pigpio_pool
 
 from multiprocessing import Process
 from apscheduler.schedulers.background import BackgroundScheduler
@@ -55,7 +56,7 @@ def main(argv):
     # Target time range to go from current levels to full on
     time_to_full = 600
    
-    pi = pigpio.pi()
+    pi = pigpio_pool.pi()
 
     # Connect the buttons
     # pi.callback(14, pigpio.RISING_EDGE, pigpio_callback)
@@ -0,0 +1,202 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# pigpio_pool.py
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+Shared, fork safe pigpio daemon connections.
+
+Call pi() instead of pigpio.pi(). It returns a pooled_pi, which takes
+the same method calls as a pigpio.pi but runs each one on a connection
+picked for the calling process and thread:
+
+- Each process opens its own connections. Connections inherited
+  over a fork are dropped, never used, so a child can not corrupt its
+  parent's socket.
+- Each thread sticks to one connection. At most max_connections are
+  opened per host; after that threads share them, which is safe as
+  pigpio locks the socket for every command.
+- A call that fails because the connection dropped is retried once
+  on a fresh connection.
+"""
+
+import os
+import struct
+import logging
+import threading
+import pigpio
+
+
+# Most connections one process opens to one pigpio daemon
+max_connections = 4
+
+
+class pool:
+    """
+    The pigpio connections of this process, by host and port.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pid = os.getpid()
+        self.connections = {}
+        self.next = {}
+
+
+    def connection(self, host, port):
+        """
+        Return the connection this thread should use for host and port.
+        """
+
+        key = (host, port)
+        if self.pid != os.getpid():
+            self.forked()
+
+        mine = getattr(self.local, 'connections', None)
+        if mine is None or self.local.pid != self.pid:
+            mine = self.local.connections = {}
+            self.local.pid = self.pid
+
+        conn = mine.get(key)
+        if conn is not None and conn.connected:
+            return conn
+
+        with self.lock:
+            conns = self.connections.setdefault(key, [])
+            conns[:] = [c for c in conns if c.connected]
+            if len(conns) < max_connections:
+                conn = connect(host, port)
+                if conn.connected:
+                    conns.append(conn)
+            else:
+                # Share round robin once the limit is reached
+                i = self.next.get(key, 0) % len(conns)
+                self.next[key] = i + 1
+                conn = conns[i]
+
+        mine[key] = conn
+        return conn
+
+
+    def reconnect(self, host, port, conn):
+        """
+        Replace a broken connection and return the new one.
+        """
+
+        key = (host, port)
+        with self.lock:
+            conns = self.connections.get(key, [])
+            if conn in conns:
+                conns.remove(conn)
+        try:
+            conn.stop()
+        except Exception:
+            pass
+
+        mine = getattr(self.local, 'connections', {})
+        mine.pop(key, None)
+        return self.connection(host, port)
+
+
+    def forked(self):
+        """
+        Forget connections inherited from the parent process.
+
+        They are not stopped, as that would talk on the parent's sockets.
+        """
+
+        with self.lock:
+            self.connections = {}
+            self.next = {}
+            self.pid = os.getpid()
+
+
+    def close(self):
+        """
+        Stop every connection this process opened.
+        """
+
+        with self.lock:
+            for conns in self.connections.values():
+                for conn in conns:
+                    conn.stop()
+            self.connections = {}
+
+
+def connect(host, port):
+    """
+    Open a new pigpio daemon connection.
+    """
+
+    logging.info(f'Connecting to pigpio at {host or "default host"}:{port or "default port"}')
+    kwargs = {}
+    if host is not None:
+        kwargs['host'] = host
+    if port is not None:
+        kwargs['port'] = port
+    return pigpio.pi(show_errors=False, **kwargs)
+
+
+# The pool for this process
+connections = pool()
+
+
+class pooled_pi:
+    """
+    A stand in for pigpio.pi that runs every call on a pooled connection.
+    """
+
+    def __init__(self, host = None, port = None):
+        self.host = host
+        self.port = port
+
+
+    @property
+    def connected(self):
+        return connections.connection(self.host, self.port).connected
+
+
+    def stop(self):
+        """
+        Connections belong to the pool. Use pigpio_pool.connections.close().
+        """
+
+        pass
+
+
+    def __getattr__(self, name):
+        """
+        Wrap a pigpio.pi method so it runs on this thread's connection.
+        """
+
+        if not callable(getattr(pigpio.pi, name, None)):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            conn = connections.connection(self.host, self.port)
+            try:
+                return getattr(conn, name)(*args, **kwargs)
+            except (OSError, struct.error, AttributeError) as e:
+                # AttributeError: pigpio clears the socket when it drops
+                logging.warning(f'pigpio connection lost ({e}), reconnecting')
+                conn = connections.reconnect(self.host, self.port, conn)
+                return getattr(conn, name)(*args, **kwargs)
+
+        # Cache the wrapper, the connection is still looked up per call
+        setattr(self, name, call)
+        return call
+
+
+def pi(host = None, port = None):
+    """
+    Return a pooled pigpio connection for host and port.
+
+    None uses the pigpio defaults (PIGPIO_ADDR or localhost and
+    PIGPIO_PORT or 8888).
+    """
+
+    return pooled_pi(host, port)
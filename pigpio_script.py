@@ -0,0 +1,103 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# pigpio_script.py
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+Compile led strip transitions into pigpio daemon scripts.
+
+A transition is given as keyframes: a list of (seconds, red, green, blue)
+tuples with the color moving in a straight line between each pair.
+Each pair becomes a small counted loop in the pigpio script language,
+so the script stays short no matter how long the transition runs and
+pigpiod does all the stepping and timing itself.
+
+See http://abyz.me.uk/rpi/pigpio/pigs.html#Scripts
+"""
+
+# Colors are stepped in fixed point as scripts only have integers
+SCALE = 1000
+
+# Longest single delay each script command accepts
+MAX_MICS = 1000000
+MAX_MILS = 60000
+
+
+def compile_transition(pins, keyframes, fps = 30):
+    """
+    Return the script text (bytes) that runs keyframes on pins.
+
+    pins is (red_pin, green_pin, blue_pin). Each segment between two
+    keyframes is split into at most fps steps per second, and never
+    more steps than the largest color change in the segment.
+    Only channels that move in a segment are written in its loop.
+
+    Variables used: v0-v2 hold the fixed point colors, v3-v5 the
+    integer colors written, v9 the loop counter.
+    """
+
+    lines = []
+    for tag, (start, end) in enumerate(zip(keyframes, keyframes[1:])):
+        seconds = end[0] - start[0]
+        c0 = [int(c) for c in start[1:]]
+        c1 = [int(c) for c in end[1:]]
+
+        distance = max(abs(b - a) for (a, b) in zip(c0, c1))
+        if distance == 0:
+            lines.extend(delay(seconds * 1000000))
+            continue
+
+        steps = max(1, min(distance, round(seconds * fps)))
+
+        for i in range(3):
+            lines.append(f'ld v{i} {c0[i] * SCALE + SCALE // 2}')
+        lines.append(f'ld v9 {steps}')
+
+        lines.append(f'tag {tag}')
+        for (i, pin) in enumerate(pins):
+            step = round((c1[i] - c0[i]) * SCALE / steps)
+            if step == 0:
+                continue
+            lines.append(f'lda v{i}')
+            if step > 0:
+                lines.append(f'add {step}')
+            else:
+                lines.append(f'sub {-step}')
+            lines.append(f'sta v{i}')
+            lines.append(f'div {SCALE}')
+            lines.append(f'sta v{i + 3}')
+            lines.append(f'pwm {pin} v{i + 3}')
+        lines.extend(delay(seconds * 1000000 / steps))
+        lines.append('dcr v9')
+        lines.append('lda v9')
+        lines.append(f'jnz {tag}')
+
+        # Land exactly on the keyframe whatever the rounding did
+        for (i, pin) in enumerate(pins):
+            lines.append(f'pwm {pin} {c1[i]}')
+
+    return ' '.join(lines).encode()
+
+
+def delay(micros):
+    """
+    Return the script commands that wait the given microseconds.
+    """
+
+    micros = round(micros)
+    lines = []
+    if micros <= 0:
+        return lines
+
+    if micros <= MAX_MICS:
+        lines.append(f'mics {micros}')
+        return lines
+
+    millis = round(micros / 1000)
+    while millis > 0:
+        lines.append(f'mils {min(millis, MAX_MILS)}')
+        millis -= MAX_MILS
+    return lines
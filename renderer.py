@@ -0,0 +1,362 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# renderer.py
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+Drive many led strips from a single frame clock.
+
+One renderer thread runs one frame loop for every strip registered
+with it. Each frame it works out the color of every running track
+under its lock, then writes the changed channels of all strips
+together with the lock released. Tracks always start
+on a frame boundary, so strips started within the same frame stay in
+lockstep for the whole transition.
+
+A track can also be armed ahead of time to start at an exact moment,
+as scheduled scenes are. The loop wakes for that moment rather than
+the next frame, and how far the first frame missed it is kept in
+drift.
+"""
+
+import math
+import time
+import logging
+import threading
+
+from contextlib import contextmanager
+
+
+class fade_track:
+    """
+    A straight line from one color to another over duration seconds.
+    """
+
+    def __init__(self, start, target, duration):
+        self.start = tuple(start)
+        self.target = tuple(int(c) for c in target)
+        self.duration = duration
+
+
+    def color(self, t):
+        """
+        Return the color t seconds into the track.
+        """
+
+        if t >= self.duration:
+            return self.target
+        fraction = t / self.duration
+        return tuple(round(s + (e - s) * fraction) for (s, e) in zip(self.start, self.target))
+
+
+class table_track:
+    """
+    A compiled scenes.scene_table played from start seconds in, its
+    first sample by default.
+    """
+
+    def __init__(self, table, start = 0):
+        self.table = table
+        self.start = start
+        self.duration = table.duration - start
+        self.i = 0
+
+
+    def color(self, t):
+        """
+        Return the color t seconds into the track.
+
+        Time only moves forward, so this walks on from the last sample
+        returned instead of searching the table.
+        """
+
+        t += self.start
+        times = self.table.times
+        while self.i < len(times) - 1 and times[self.i + 1] <= t:
+            self.i += 1
+        return self.table.color(self.i)
+
+
+class renderer:
+    """
+    One frame loop for every registered led strip.
+    """
+
+    def __init__(self, fps = 30):
+        """
+        Create a renderer running at fps frames per second.
+
+        The frame loop thread is started on first use, and started
+        again if it did not survive a fork.
+        """
+
+        self.thread = None
+        self.fps = fps
+        self.epoch = time.monotonic()
+        self.strips = []
+
+        # strip -> (action name, track, begin)
+        self.tracks = {}
+        # Tracks waiting to start, the same
+        self.armed = {}
+        # How late armed tracks started: count, last, mean and max in ms
+        self.drift = {'count': 0, 'last': 0, 'mean': 0, 'max': 0}
+        self.lock = threading.Condition()
+        self.frames = 0
+
+        # Frame every track starts on inside batch(), else None
+        self.begin = None
+
+
+    def register(self, strip):
+        """
+        Have this renderer run the fades and scenes of strip.
+        """
+
+        if strip not in self.strips:
+            self.strips.append(strip)
+        strip.renderer = self
+
+
+    def next_frame(self):
+        """
+        Return the monotonic time of the next frame boundary.
+
+        Inside batch() this is the frame the batch starts on.
+        """
+
+        if self.begin is not None:
+            return self.begin
+        frame = math.floor((time.monotonic() - self.epoch) * self.fps) + 1
+        return self.epoch + frame / self.fps
+
+
+    def play(self, strip, name, track):
+        """
+        Start track on strip, replacing whatever it is running.
+
+        The track begins on the next frame.
+        """
+
+        with self.lock:
+            self.install(strip, name, track, self.next_frame())
+
+
+    def fade(self, strip, target, duration):
+        """
+        Fade strip to target over duration seconds.
+
+        If the strip is part way through a track the fade carries on
+        from the color that track would have on the next frame, so
+        changing target mid fade never jumps. The latest call wins.
+        """
+
+        with self.lock:
+            begin = self.next_frame()
+            if strip in self.tracks:
+                (name, track, started) = self.tracks[strip]
+                start = track.color(max(0, begin - started))
+            else:
+                start = strip.get()
+            self.install(strip, 'fade', fade_track(start, target, duration), begin)
+
+
+    def arm(self, strip, name, track, begin):
+        """
+        Start track on strip at the monotonic time begin, not on a
+        frame boundary. Until then the strip carries on with whatever
+        it is doing. Anything played on the strip, or stopping it,
+        before then cancels the armed track.
+        """
+
+        with self.lock:
+            self.wake()
+            self.armed[strip] = (name, track, begin)
+            self.lock.notify()
+
+
+    @contextmanager
+    def batch(self):
+        """
+        Start every track played or faded inside the with block on the
+        same frame.
+
+        The lock is held for the whole block, so no frame is written
+        until every change in it is in place.
+        """
+
+        with self.lock:
+            outer = self.begin is None
+            if outer:
+                self.begin = self.next_frame()
+            try:
+                yield self
+            finally:
+                if outer:
+                    self.begin = None
+
+
+    def install(self, strip, name, track, begin):
+        """
+        Make track the one strip runs from begin. Call with the lock held.
+        """
+
+        self.wake()
+        self.armed.pop(strip, None)
+        self.tracks[strip] = (name, track, begin)
+        self.lock.notify()
+
+
+    def wake(self):
+        """
+        Start the frame loop if it is not running. Call with the lock held.
+        """
+
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+
+    def stop(self, strip, name = None):
+        """
+        Stop the track running on strip, and any armed for it.
+
+        If a name is given only a track with that name is stopped.
+        """
+
+        with self.lock:
+            if strip in self.tracks and (name is None or self.tracks[strip][0] == name):
+                del self.tracks[strip]
+            self.disarm(strip, name)
+
+
+    def disarm(self, strip, name = None):
+        """
+        Cancel the track armed for strip, if it has not started.
+
+        If a name is given only a track with that name is cancelled.
+        """
+
+        with self.lock:
+            if strip in self.armed and (name is None or self.armed[strip][0] == name):
+                logging.info(f'Armed track {self.armed[strip][0]} cancelled')
+                del self.armed[strip]
+
+
+    def active(self, strip):
+        """
+        Return the name of the track running on strip, or False if none.
+        """
+
+        with self.lock:
+            if strip in self.tracks:
+                return self.tracks[strip][0]
+        return False
+
+
+    def run(self):
+        """
+        Frame loop thread. Do not call directly, play() starts it.
+        """
+
+        frame = self.next_frame()
+        while True:
+            with self.lock:
+                if not self.tracks and not self.armed:
+                    self.lock.wait()
+                    frame = self.next_frame()
+                    continue
+
+                due = frame if self.tracks else math.inf
+                for (name, track, begin) in self.armed.values():
+                    due = min(due, begin)
+
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self.lock.wait(wait)
+                    continue
+
+                writes = self.render(time.monotonic())
+                frame = self.next_frame()
+            self.write(writes)
+
+
+    def render(self, now):
+        """
+        Work out one frame for every strip with a running track.
+
+        Call with the lock held. Returns the writes for write() to
+        send once it is released, so a slow pigpio daemon never holds
+        up anyone waiting for the lock.
+        """
+
+        self.frames += 1
+        for strip in [s for s in self.armed if self.armed[s][2] <= now]:
+            self.tracks[strip] = self.armed.pop(strip)
+            self.drifted(now - self.tracks[strip][2])
+
+        writes = []
+        for strip in list(self.tracks):
+            (name, track, begin) = self.tracks[strip]
+            t = now - begin
+            if t < 0:
+                continue
+            try:
+                writes.append((strip, name, track, track.color(t), t >= track.duration))
+            except Exception:
+                logging.exception(f'Track {name} failed')
+                del self.tracks[strip]
+        return writes
+
+
+    def write(self, writes):
+        """
+        Send a frame worked out by render(). Call without the lock.
+
+        A write is skipped if its track was stopped or replaced since.
+        A finished track is only dropped once its last frame is written,
+        so it stays active() until the strip shows its final color. A
+        strip that fails to write has its track stopped.
+        """
+
+        for (strip, name, track, color, finished) in writes:
+            if not self.installed(strip, track):
+                continue
+            try:
+                strip.direct_set(*color)
+            except Exception:
+                logging.exception(f'Track {name} failed')
+                finished = True
+            else:
+                if finished:
+                    logging.info(f'Track {name} finished')
+            if finished:
+                with self.lock:
+                    if self.installed(strip, track):
+                        del self.tracks[strip]
+
+
+    def installed(self, strip, track):
+        """
+        Return True if track is the one strip is running.
+        """
+
+        with self.lock:
+            return strip in self.tracks and self.tracks[strip][1] is track
+
+
+    def drifted(self, late):
+        """
+        Record that an armed track started late seconds after its time.
+        """
+
+        late *= 1000
+        drift = self.drift
+        drift['count'] += 1
+        drift['last'] = late
+        drift['mean'] += (late - drift['mean']) / drift['count']
+        drift['max'] = max(drift['max'], late)
+        logging.info(f'Armed track started {late:.2f} ms late')
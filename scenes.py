@@ -0,0 +1,176 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# scenes.py
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+Lighting scenes defined as keyframe curves.
+
+A scene is a list of (time, red, green, blue) keyframes. Time runs
+from 0 (start) to 1 (end of the scene) and each color runs from
+0 (off) to 1 (full on), so a scene does not depend on its duration or
+on the pwm range of the strip it is played on. Colors move in a
+straight line between keyframes.
+
+Scenes are compiled once per (duration, pwm_range, fps) into a
+scene_table and the tables are cached, so playing a scene only has to
+walk a table.
+"""
+
+import functools
+from array import array
+
+
+SCENES = {
+    # Red dawn, then brighten through yellow to full white
+    'sunrise': [
+        (0.0, 0.0, 0.0, 0.0),
+        (0.1, 1.0, 0.06, 0.0),
+        (0.56, 1.0, 1.0, 0.12),
+        (1.0, 1.0, 1.0, 1.0),
+    ],
+    # Sunrise backwards
+    'sunset': [
+        (0.0, 1.0, 1.0, 1.0),
+        (0.44, 1.0, 1.0, 0.12),
+        (0.9, 1.0, 0.06, 0.0),
+        (1.0, 0.0, 0.0, 0.0),
+    ],
+}
+
+
+class scene_table:
+    """
+    A compiled scene: the pwm values to write and when to write them.
+
+    times holds the seconds from the start of the scene for each sample.
+    colors holds the red, green and blue pwm values of each sample,
+    three entries per sample. Only samples where the color changes are
+    kept, and the last sample is always at exactly duration.
+    """
+
+    def __init__(self, duration):
+        self.duration = duration
+        self.times = array('d')
+        self.colors = array('H')
+
+
+    def __len__(self):
+        return len(self.times)
+
+
+    def color(self, i):
+        """
+        Return the (red, green, blue) pwm values of sample i.
+        """
+
+        return tuple(self.colors[i * 3:i * 3 + 3])
+
+
+def names():
+    """
+    Return the names of the known scenes.
+    """
+
+    return list(SCENES)
+
+
+def keyframes(name, duration, pwm_range):
+    """
+    Return a scene's keyframes in seconds and pwm values.
+
+    Raises KeyError for an unknown scene.
+    """
+
+    return [(t * duration, *to_pwm((r, g, b), pwm_range)) for (t, r, g, b) in SCENES[name]]
+
+
+@functools.lru_cache(maxsize=32)
+def compile_scene(name, duration, pwm_range, fps = 30):
+    """
+    Compile a scene into a scene_table. Results are cached.
+
+    Raises KeyError for an unknown scene.
+    """
+
+    frames = keyframes(name, duration, pwm_range)
+    table = scene_table(duration)
+    count = max(1, round(duration * fps))
+
+    last = None
+    segment = 0
+    for frame in range(count + 1):
+        t = duration * frame / count
+        while segment < len(frames) - 2 and t > frames[segment + 1][0]:
+            segment += 1
+
+        color = interpolate(frames[segment], frames[min(segment + 1, len(frames) - 1)], t)
+        if color != last or frame == count:
+            table.times.append(t)
+            table.colors.extend(color)
+            last = color
+
+    return table
+
+
+def resume_time(table, color):
+    """
+    Return the seconds into table where the scene first reaches the
+    total brightness of the pwm color, or its duration if it never
+    does.
+
+    A scene that brightens (sunrise) resumes at its first sample at
+    least as bright, so a lit strip is not dimmed first. One that dims
+    (sunset) resumes at its first sample no brighter, so a dim strip is
+    not brightened first. Either way a strip already at the scene's
+    starting level starts from the beginning.
+    """
+
+    # pwm 0 is full on, so brighter is a smaller sum
+    level = sum(color)
+    dims = sum(table.color(len(table) - 1)) > sum(table.color(0))
+    for i in range(len(table)):
+        sample = sum(table.color(i))
+        if (sample >= level) if dims else (sample <= level):
+            return table.times[i]
+    return table.duration
+
+
+def trim(frames, start):
+    """
+    Return keyframes (in seconds) starting start seconds in, with
+    times counted from there.
+    """
+
+    if start <= 0:
+        return frames
+
+    segment = 0
+    while segment < len(frames) - 2 and start > frames[segment + 1][0]:
+        segment += 1
+    first = (0, *interpolate(frames[segment], frames[segment + 1], start))
+    return [first] + [(t - start, *color) for (t, *color) in frames if t > start]
+
+
+def interpolate(start, end, t):
+    """
+    Return the pwm color at t seconds between two keyframes.
+    """
+
+    span = end[0] - start[0]
+    if span <= 0:
+        return tuple(end[1:])
+
+    fraction = min(1, max(0, (t - start[0]) / span))
+    return tuple(round(a + (b - a) * fraction) for (a, b) in zip(start[1:], end[1:]))
+
+
+def to_pwm(color, pwm_range):
+    """
+    Convert 0 (off) to 1 (full on) levels into pwm values (0 is full on).
+    """
+
+    return tuple(round(pwm_range * (1 - c)) for c in color)
@@ -0,0 +1,135 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# solar.py
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+Sunrise and sunset times, and an APScheduler trigger relative to them.
+
+The times come from the sunrise equation (the NOAA approximation,
+good to a minute or so outside the polar circles), worked out here
+from latitude and longitude with no network or extra packages. Each
+day's times for a place are worked out once and cached, so a trigger
+asking again, or a timeline of the next N fire times, costs a lookup.
+
+    trigger = solar_trigger('sunset', 34.05, -118.24, offset=-30)
+    scheduler.add_job(light_jobs.run, trigger, args=['sunset', 'all', {}])
+"""
+
+import math
+
+from functools import lru_cache
+from datetime import datetime, timedelta, timezone
+
+from apscheduler.triggers.base import BaseTrigger
+
+
+# Julian date of the J2000 epoch, 2000-01-01 12:00 UTC
+J2000 = 2451545.0
+epoch = datetime(2000, 1, 1, 12, tzinfo=timezone.utc)
+
+# Sun's centre below the horizon at sunrise and sunset, for refraction
+# and the size of the sun's disc, in degrees
+horizon = -0.833
+
+# Most days to look ahead for a sunrise or sunset (there may be none
+# for months inside the polar circles)
+max_days = 370
+
+EVENTS = ('sunrise', 'sunset')
+
+
+@lru_cache(maxsize=64)
+def sun_times(latitude, longitude, day):
+    """
+    Return (sunrise, sunset) as UTC datetimes for a place on a date.
+
+    Either is None when the sun does not rise or set that day.
+    Longitude is positive east.
+    """
+
+    julian = day.toordinal() + 1721424.5
+    n = math.ceil(julian - J2000 + 0.0008)
+    mean = n - longitude / 360
+
+    anomaly = (357.5291 + 0.98560028 * mean) % 360
+    m = math.radians(anomaly)
+    centre = 1.9148 * math.sin(m) + 0.0200 * math.sin(2 * m) + 0.0003 * math.sin(3 * m)
+    ecliptic = math.radians((anomaly + centre + 180 + 102.9372) % 360)
+    transit = mean + 0.0053 * math.sin(m) - 0.0069 * math.sin(2 * ecliptic)
+
+    declination = math.asin(math.sin(ecliptic) * math.sin(math.radians(23.4397)))
+    phi = math.radians(latitude)
+    cos_hour = ((math.sin(math.radians(horizon)) - math.sin(phi) * math.sin(declination))
+                / (math.cos(phi) * math.cos(declination)))
+    if abs(cos_hour) > 1:
+        return (None, None)
+
+    hour = math.degrees(math.acos(cos_hour)) / 360
+    return (epoch + timedelta(days=transit - hour), epoch + timedelta(days=transit + hour))
+
+
+def next_event(event, latitude, longitude, after, offset = 0):
+    """
+    Return the first sunrise or sunset, plus offset minutes, later
+    than the aware datetime after. None if there is none within
+    max_days.
+    """
+
+    which = EVENTS.index(event)
+    delta = timedelta(minutes=offset)
+    # Start a day early: the UTC date of an event is not always the
+    # local one, and a big offset can move it to another day
+    first = after.astimezone(timezone.utc).date() - timedelta(days=1 + abs(offset) // 1440)
+    for days in range(max_days):
+        when = sun_times(latitude, longitude, first + timedelta(days=days))[which]
+        if when is not None and when + delta > after:
+            return when + delta
+    return None
+
+
+class solar_trigger(BaseTrigger):
+    """
+    Fire every day at sunrise or sunset, plus offset minutes
+    (negative for before).
+    """
+
+    def __init__(self, event, latitude, longitude, offset = 0, timezone = None):
+        """
+        Fire times are given in timezone, UTC if not set.
+        Raises ValueError for an unknown event or place.
+        """
+
+        if event not in EVENTS:
+            raise ValueError(f'event must be one of {", ".join(EVENTS)}, not {event!r}')
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+            raise ValueError(f'no such place {latitude}, {longitude}')
+
+        self.event = event
+        self.latitude = latitude
+        self.longitude = longitude
+        self.offset = offset
+        self.timezone = timezone
+
+
+    def get_next_fire_time(self, previous_fire_time, now):
+        if previous_fire_time is not None:
+            after = min(now, previous_fire_time)
+        else:
+            after = now - timedelta(microseconds=1)
+
+        when = next_event(self.event, self.latitude, self.longitude, after, self.offset)
+        if when is not None and self.timezone is not None:
+            when = when.astimezone(self.timezone)
+        return when
+
+
+    def __str__(self):
+        return f'solar[{self.event} {self.offset:+g} min at {self.latitude}, {self.longitude}]'
+
+
+    def __repr__(self):
+        return f'<solar_trigger ({self.event!r}, {self.latitude}, {self.longitude}, offset={self.offset})>'
@@ -0,0 +1,244 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:fenc=utf-8
+#
+# state_cache.py
+#
+# Distributed under terms of the GPLv3 license.
+
+"""
+A versioned, ready to serve snapshot of the state of many led strips.
+
+The cache listens to its strips. Every state change bumps a counter
+and wakes anyone waiting for one; the snapshot and its JSON are only
+rebuilt when someone asks for them after a change, so a running fade
+costs a counter increment per frame.
+
+The version handed out, and so the ETag, is that counter behind a
+random id for this cache. The counter starts again from 1 when the
+process restarts, but the id does not, so a version or ETag from
+before a restart never matches one from after it.
+
+state_stream fans the snapshot out to any number of Server-Sent Events
+subscribers from one producer thread.
+"""
+
+import os
+import json
+import time
+import threading
+from collections import deque
+
+
+class state_cache:
+    """
+    Snapshot of {name: (red, green, blue)} for a set of named strips.
+    """
+
+    def __init__(self, strips):
+        """
+        strips is a dict of name: led_strip to watch.
+        """
+
+        self.strips = strips
+        self.boot = os.urandom(4).hex()
+        self.version = 1
+        self.built = 0
+        self.snapshot = {}
+        self.body = b'{}'
+        self.lock = threading.Condition()
+
+        for strip in strips.values():
+            strip.listeners.append(self.changed)
+
+
+    def changed(self, strip = None):
+        """
+        Strip listener: note that the state has changed.
+        """
+
+        with self.lock:
+            self.version += 1
+            self.lock.notify_all()
+
+
+    def current(self):
+        """
+        Return the current version string. Call with the lock held.
+        """
+
+        return f'{self.boot}-{self.version}'
+
+
+    def get(self):
+        """
+        Return (version, snapshot dict, JSON body bytes).
+        """
+
+        with self.lock:
+            if self.built != self.version:
+                self.snapshot = {name: strip.get() for (name, strip) in self.strips.items()}
+                self.body = json.dumps(self.snapshot).encode()
+                self.built = self.version
+            return (self.current(), self.snapshot, self.body)
+
+
+    def etag(self, version = None):
+        """
+        Return the ETag for a version (the current one by default).
+        """
+
+        if version is None:
+            with self.lock:
+                return self.current()
+        return version
+
+
+    def wait(self, version, timeout):
+        """
+        Wait up to timeout seconds for the state to move past version.
+
+        Returns True if it did.
+        """
+
+        end = time.monotonic() + timeout
+        with self.lock:
+            while self.current() == version:
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.lock.wait(remaining)
+            return True
+
+
+class state_stream:
+    """
+    Push state changes to many subscribers as Server-Sent Events.
+
+    One producer thread waits for the cache to change, at most fps
+    times a second, and formats each event once. Each subscriber gets
+    it in a small buffer of its own; a full buffer drops its oldest
+    events, so a slow subscriber skips intermediate frames but always
+    ends up with the latest state, and never holds up the producer.
+    """
+
+    def __init__(self, cache, fps = 10, buffer = 4, keepalive = 15):
+        """
+        fps is the most events a second sent to anyone, buffer the
+        events held per subscriber, keepalive the seconds between
+        comments sent to idle subscribers.
+        """
+
+        self.cache = cache
+        self.fps = fps
+        self.buffer = buffer
+        self.keepalive = keepalive
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.events = 0
+
+
+    def event(self):
+        """
+        Return the current state as an SSE event.
+        """
+
+        (version, snapshot, body) = self.cache.get()
+        return (version, b'id: %s\nevent: state\ndata: %s\n\n' % (version.encode(), body))
+
+
+    def subscribe(self, fps = None):
+        """
+        Return a generator of SSE event bytes for one subscriber.
+
+        It starts with the current state, then sends changes at most
+        fps times a second (no more than the stream's own fps).
+        Closing the generator unsubscribes.
+        """
+
+        queue = subscriber(self.buffer)
+        queue.push(self.event()[1])
+        with self.lock:
+            self.subscribers.add(queue)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+        fps = min(fps or self.fps, self.fps)
+        return self.follow(queue, 1 / fps)
+
+
+    def follow(self, queue, interval):
+        """
+        Generator behind subscribe().
+        """
+
+        try:
+            while True:
+                event = queue.pop(self.keepalive)
+                if event is None:
+                    yield b': keepalive\n\n'
+                    continue
+                yield event
+                time.sleep(interval)
+        finally:
+            with self.lock:
+                self.subscribers.discard(queue)
+
+
+    def run(self):
+        """
+        Producer thread. Do not call directly, subscribe() starts it.
+        """
+
+        version = self.cache.get()[0]
+        while True:
+            if not self.cache.wait(version, self.keepalive):
+                continue
+
+            (version, event) = self.event()
+            self.events += 1
+            with self.lock:
+                queues = list(self.subscribers)
+            for queue in queues:
+                queue.push(event)
+
+            time.sleep(1 / self.fps)
+
+
+class subscriber:
+    """
+    A bounded buffer of events for one stream subscriber.
+    """
+
+    def __init__(self, size):
+        self.events = deque(maxlen=size)
+        self.ready = threading.Event()
+        self.dropped = 0
+
+
+    def push(self, event):
+        """
+        Add an event, dropping the oldest if full. Never blocks.
+        """
+
+        if len(self.events) == self.events.maxlen:
+            self.dropped += 1
+        self.events.append(event)
+        self.ready.set()
+
+
+    def pop(self, timeout):
+        """
+        Return the newest event, skipping older ones, or None on timeout.
+        """
+
+        if not self.ready.wait(timeout):
+            return None
+        self.ready.clear()
+
+        event = None
+        while self.events:
+            event = self.events.popleft()
+        return event